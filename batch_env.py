@@ -0,0 +1,226 @@
+#!/usr/bin/python
+
+# Many copies of the simulation's world stepped at once
+
+import argparse
+import math
+import time
+
+import numpy
+
+import sim
+import wire
+
+# Notes:
+# 	BatchEnv keeps N independent worlds (the same as a headless sim.Map: walls,
+# 	enemies and a player) as NumPy arrays with one row per world, so a tick is
+# 	a handful of array operations no matter how many worlds there are, and
+# 	observe() gives an N x sensors matrix that can go straight into
+# 	NeuralNetwork.feedForwardBatch().
+#
+# 	The rules are the same as the GameObject versions, down to pygame.Rect
+# 	truncating positions to whole pixels, so a world stepped here follows the
+# 	same path as a Simulation(headless=True) given the same commands.
+
+class BatchEnv(object):
+
+	def __init__(self, num_worlds, walls=sim.WALLS, enemies=sim.ENEMIES,
+			player_start=sim.PLAYER_START, goal=sim.GOAL, dimension=sim.GAME_RESOLUTION,
+			moving_enemies=False, player_radius=10, enemy_radius=10, goal_radius=10,
+			feeler_count=sim.FEELER_COUNT, feeler_length=sim.FEELER_LENGTH, feeler_fov=sim.FEELER_FOV):
+		""" 	num_worlds => how many worlds to step together
+			walls, enemies, player_start, goal => the layout every world starts with
+			dimension => the size of the map (enemies wrap around its width)
+			moving_enemies => move the enemies like Enemy (Map uses StaticEnemy)
+			feeler_count, feeler_length, feeler_fov => see Player.set_feelers()
+		"""
+		self.num_worlds = num_worlds
+		self.width, self.height = dimension
+		self.player_radius = player_radius
+		self.enemy_radius = enemy_radius
+		self.player_start = player_start
+
+		self.speed = sim.Player.speed
+		self.rotation_speed = sim.Player.rotation_speed
+		self.radar_radius = sim.Player.radar_radius
+		self.enemy_speed = sim.Enemy.speed if moving_enemies else 0.0
+
+		# Every world's walls as rows of (x, y, width, height), so each world
+		# can be given its own geometry, and their edges for the collision
+		# test (change both together)
+		wall_rects = numpy.array([ pos + dim for pos, dim in walls ], dtype=float).reshape(-1, 4)
+		self.wall_rects = numpy.empty((num_worlds, len(wall_rects), 4))
+		self.wall_rects[:] = wall_rects
+		self.wall_left = self.wall_rects[..., 0]
+		self.wall_top = self.wall_rects[..., 1]
+		self.wall_right = self.wall_left + self.wall_rects[..., 2]
+		self.wall_bottom = self.wall_top + self.wall_rects[..., 3]
+
+		# The goal's center
+		self.goal_x = goal[0] + goal_radius
+		self.goal_y = goal[1] + goal_radius
+
+		self.feeler_length = feeler_length
+		self.feeler_offsets = (numpy.arange(feeler_count) + .5) * (feeler_fov / feeler_count) - feeler_fov / 2
+		self.feeler_distances = numpy.empty((num_worlds, feeler_count))
+
+		# Enemies by the top left of their rect, like Enemy
+		self.enemy_starts = numpy.array(enemies, dtype=float).reshape(-1, 2)
+		self.enemy_x = numpy.empty((num_worlds, len(self.enemy_starts)))
+		self.enemy_y = numpy.empty((num_worlds, len(self.enemy_starts)))
+		# (x, y, width, height) of every world's enemies, for sim.radar_hits()
+		self.enemy_rects = numpy.empty((num_worlds, len(self.enemy_starts), 4))
+		self.enemy_rects[..., 2:] = 2 * enemy_radius
+		# Which enemies each world's radar picked up on the last tick
+		self.detected = numpy.zeros((num_worlds, len(self.enemy_starts)), dtype=bool)
+
+		# The player's pose (x, y are floats, the rect's top left is them
+		# truncated, like pygame.Rect does)
+		self.x = numpy.empty(num_worlds)
+		self.y = numpy.empty(num_worlds)
+		self.theta = numpy.empty(num_worlds)
+		self.collisions = numpy.zeros(num_worlds, dtype=int)
+		self.ticks = 0
+
+		# The controls each world's player is holding, in wire.COMMANDS order
+		self.controls = numpy.zeros((num_worlds, len(wire.COMMANDS)), dtype=bool)
+		# Laid out like Player.get_info()
+		self.observation_size = 4 + feeler_count + len(self.enemy_starts) + 2
+		self.observation = numpy.empty((num_worlds, self.observation_size), dtype=numpy.float32)
+
+		self.reset()
+
+	def reset(self, worlds=None):
+		""" Put the given worlds (an index array or mask, all by default) back at the start """
+		if worlds is None:
+			worlds = slice(None)
+
+		self.x[worlds], self.y[worlds] = self.player_start
+		# Facing the top of the screen, like Player
+		self.theta[worlds] = math.pi
+		self.enemy_x[worlds] = self.enemy_starts[:, 0]
+		self.enemy_y[worlds] = self.enemy_starts[:, 1]
+		self.detected[worlds] = False
+		self.collisions[worlds] = 0
+		self.controls[worlds] = False
+		self.feelers()
+
+	def set_controls(self, commands):
+		""" Set the held controls from an array of N command masks or an N x 3 array """
+		commands = numpy.asarray(commands)
+		if commands.ndim == 1:
+			bits = 1 << numpy.arange(len(wire.COMMANDS))
+			self.controls[:] = (commands[:, None] & bits) != 0
+		else:
+			self.controls[:] = commands.astype(bool)
+
+	def step(self, commands=None):
+		""" 	Run one tick in every world and return the observations
+
+			commands => see set_controls() (None keeps the current ones)
+		"""
+		if commands is not None:
+			self.set_controls(commands)
+
+		# Map updates its walls, then its enemies, then the player, which
+		# moves and then senses
+		self.move_enemies()
+
+		turn_right, turn_left, move_forward = self.controls.T
+		self.go_forward(move_forward)
+		self.theta -= turn_left * self.rotation_speed
+		self.theta += turn_right * self.rotation_speed
+
+		self.radar()
+		self.feelers()
+
+		self.ticks += 1
+		return self.observe()
+
+	def move_enemies(self):
+		if not self.enemy_speed:
+			return
+
+		# Enemy.update moves the rect's centerx, which pygame keeps as an int
+		center = self.enemy_x + self.enemy_radius
+		center = numpy.trunc((center + self.enemy_speed) % self.width)
+		self.enemy_x = center - self.enemy_radius
+
+	def radar(self):
+		""" Set detected to which enemies are within radar range of each player """
+		# Rect centers (the rects are on whole pixels)
+		player_x = numpy.trunc(self.x)[:, None] + self.player_radius
+		player_y = numpy.trunc(self.y)[:, None] + self.player_radius
+
+		self.enemy_rects[..., 0] = self.enemy_x
+		self.enemy_rects[..., 1] = self.enemy_y
+		return sim.radar_hits(player_x, player_y, self.enemy_rects, self.radar_radius, out=self.detected)
+
+	def feelers(self):
+		""" Cast every world's feelers into feeler_distances """
+		center_x = numpy.trunc(self.x)[:, None, None] + self.player_radius
+		center_y = numpy.trunc(self.y)[:, None, None] + self.player_radius
+		angles = self.theta[:, None] + self.feeler_offsets
+		return sim.cast_rays(center_x, center_y, angles, self.feeler_length, self.wall_rects,
+			out=self.feeler_distances)
+
+	def go_forward(self, moving):
+		""" Move the players that are holding move_forward, unless they'd hit a wall """
+		new_x = self.x + moving * (self.speed * numpy.cos(self.theta))
+		new_y = self.y + moving * (self.speed * numpy.sin(self.theta))
+
+		# The rect each player would have at its new position
+		left = numpy.trunc(new_x)[:, None]
+		top = numpy.trunc(new_y)[:, None]
+		size = 2 * self.player_radius
+		hits = ((left < self.wall_right) & (left + size > self.wall_left) &
+				(top < self.wall_bottom) & (top + size > self.wall_top)).any(axis=1)
+
+		blocked = moving & hits
+		self.collisions += blocked
+		self.x = numpy.where(blocked, self.x, new_x)
+		self.y = numpy.where(blocked, self.y, new_y)
+
+	def observe(self):
+		""" Return every world's Player.get_info() as rows of a (reused) matrix """
+		observation = self.observation
+		observation[:, 0] = self.x
+		observation[:, 1] = self.y
+		observation[:, 2] = numpy.cos(self.theta)
+		observation[:, 3] = numpy.sin(self.theta)
+
+		feelers_end = 4 + self.feeler_distances.shape[1]
+		observation[:, 4:feelers_end] = self.feeler_distances
+		radar_end = feelers_end + self.detected.shape[1]
+		observation[:, feelers_end:radar_end] = self.detected
+
+		goal_x = self.goal_x - (numpy.trunc(self.x) + self.player_radius)
+		goal_y = self.goal_y - (numpy.trunc(self.y) + self.player_radius)
+		distance = numpy.hypot(goal_x, goal_y)
+		distance[distance == 0] = 1.0
+		observation[:, radar_end] = goal_x / distance
+		observation[:, radar_end + 1] = goal_y / distance
+		return observation
+
+def main():
+	parser = argparse.ArgumentParser(description='Time stepping many worlds at once')
+	parser.add_argument('--worlds', type=int, default=256, help='number of worlds')
+	parser.add_argument('--ticks', type=int, default=10000, help='ticks to run')
+	args = parser.parse_args()
+
+	env = BatchEnv(args.worlds)
+	rand = numpy.random.RandomState(0)
+
+	start = time.time()
+	for tick in xrange(args.ticks):
+		if tick % 30 == 0:
+			commands = rand.randint(0, 8, args.worlds)
+		env.step(commands)
+	seconds = time.time() - start
+
+	world_ticks = args.worlds * args.ticks
+	print "{} worlds x {} ticks in {:.2f} s: {:.0f} world ticks/s".format(
+		args.worlds, args.ticks, seconds, world_ticks / seconds)
+
+if __name__ == "__main__":
+	main()
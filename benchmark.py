@@ -0,0 +1,180 @@
+# Neural Network
+# -- benchmark.py
+#
+# @package NeuralNetwork
+
+# Runs every combination of the settings in a spec (layer sizes, batch sizes,
+# worker counts and backends) and appends one JSON line per combination to a
+# results file, so runs from different days/machines can be compared.
+#
+# The backends are:
+#   sequential - the pure Python layers from sequential_nn.py
+#   numpy      - the NumPy layers from sequential_nn.py
+#   threaded   - parallel_nn.py on a thread pool (Java's on Jython)
+#   process    - parallel_nn.py on a ProcessPool (CPython only)
+#
+# The spec is SPEC below, or a JSON file with the same keys:
+#
+#   $ python benchmark.py
+#   $ python benchmark.py my_spec.json --output results.jsonl
+#
+# Building a network (random weights, starting worker processes) is timed
+# separately from activating it, and each activation is repeated 'repeats'
+# times (after one warm up run) so the spread can be seen too.
+
+import argparse
+import json
+import math
+import platform
+import random
+import sys
+import time
+
+import sequential_nn
+import parallel_nn
+
+SPEC = {
+    'layers': [ [100, 120, 1], [1000, 1200, 1] ],
+    'batch_sizes': [ 1, 32 ],
+    'workers': [ 1, 2, 4, 8 ],
+    'backends': [ 'sequential', 'numpy', 'threaded', 'process' ],
+    'repeats': 5,
+    # Same weights for every run (and every backend) of a given size
+    'seed': 0,
+}
+
+RESULTS_FILE = 'benchmark_results.jsonl'
+
+# The backends whose speed depends on the number of workers
+PARALLEL_BACKENDS = [ 'threaded', 'process' ]
+
+def backendAvailable(backend):
+    if backend == 'numpy':
+        return sequential_nn.numpy is not None
+    if backend == 'process':
+        return not parallel_nn.USE_JAVA
+    return backend in [ 'sequential', 'threaded' ]
+
+def buildNetwork(backend, layers, workers, seed):
+    """ Return (network, pool) for a backend, pool being None or something
+        with a shutdown() method
+    """
+    if backend == 'sequential':
+        return sequential_nn.NeuralNetwork(layers, use_numpy=False, seed=seed), None
+    if backend == 'numpy':
+        return sequential_nn.NeuralNetwork(layers, use_numpy=True, seed=seed), None
+
+    # parallel_nn.py reads these globals when it activates a layer
+    parallel_nn.USE_LOW_LEVEL_TASKS = True
+    parallel_nn.NUM_THREADS = workers
+    nn = parallel_nn.NeuralNetwork(layers, seed=seed)
+    if parallel_nn.USE_JAVA:
+        # Java won't exit with a live thread pool around
+        parallel_nn.threadpool.shutdown()
+        pool = parallel_nn.java.util.concurrent.Executors.newFixedThreadPool(workers)
+    else:
+        pool = parallel_nn.ProcessPool(nn.layers, workers, threads=(backend == 'threaded'))
+    parallel_nn.threadpool = pool
+
+    return nn, pool
+
+def activate(nn, batch):
+    if len(batch) == 1:
+        return nn.feedForward(batch[0])
+    return nn.feedForwardBatch(batch)
+
+def summarize(times):
+    mean = sum(times) / len(times)
+    variance = sum((t - mean) ** 2 for t in times) / len(times)
+    return mean, math.sqrt(variance)
+
+def runOne(backend, layers, batch_size, workers, repeats, seed):
+    rand = random.Random(0)
+    batch = [ [ rand.random() for i in range(layers[0]) ] for row in range(batch_size) ]
+
+    start = time.time()
+    nn, pool = buildNetwork(backend, layers, workers, seed)
+    init_seconds = time.time() - start
+
+    try:
+        # Warm up (page in the weights, start the workers' first tasks)
+        activate(nn, batch)
+
+        times = []
+        for i in range(repeats):
+            start = time.time()
+            activate(nn, batch)
+            times.append(time.time() - start)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    mean, stdev = summarize(times)
+    return {
+        'backend': backend,
+        'layers': layers,
+        'batch_size': batch_size,
+        'workers': workers,
+        'repeats': repeats,
+        'init_seconds': init_seconds,
+        'activation_seconds': times,
+        'mean_seconds': mean,
+        'stdev_seconds': stdev,
+        'min_seconds': min(times),
+        'samples_per_second': batch_size / mean if mean else None,
+    }
+
+def configurations(spec):
+    """ Yield (backend, layers, batch_size, workers) for every run in a spec """
+    for backend in spec['backends']:
+        workers_list = spec['workers'] if backend in PARALLEL_BACKENDS else [ 1 ]
+        for layers in spec['layers']:
+            for batch_size in spec['batch_sizes']:
+                for workers in workers_list:
+                    yield backend, layers, batch_size, workers
+
+def run(spec, output=RESULTS_FILE):
+    environment = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'platform': platform.platform(),
+    }
+
+    results = []
+    with open(output, 'a') as results_file:
+        for backend, layers, batch_size, workers in configurations(spec):
+            if not backendAvailable(backend):
+                print "Skipping {} (not available here)".format(backend)
+                continue
+
+            result = runOne(backend, layers, batch_size, workers, spec['repeats'], spec['seed'])
+            result.update(environment)
+            results_file.write(json.dumps(result, sort_keys=True) + '\n')
+            results_file.flush()
+            results.append(result)
+
+            print "{:>10} {:>20} batch {:>4} workers {:>2}: init {:.4f}s, activate {:.4f}s +/- {:.4f}s".format(
+                backend, layers, batch_size, workers, result['init_seconds'],
+                result['mean_seconds'], result['stdev_seconds'])
+
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the neural network backends')
+    parser.add_argument('spec', nargs='?', help='JSON file with the same keys as SPEC')
+    parser.add_argument('--output', default=RESULTS_FILE, help='file to append the results to')
+    args = parser.parse_args()
+
+    spec = dict(SPEC)
+    if args.spec:
+        with open(args.spec) as spec_file:
+            spec.update(json.load(spec_file))
+
+    run(spec, args.output)
+
+if __name__ == "__main__":
+    main()
+
+# vim:ts=4:sw=4:sta:et:
@@ -0,0 +1,231 @@
+# Neural Network
+# -- episodes.py
+#
+# @package NeuralNetwork
+
+# Recording runs of the simulation and playing them back without it.
+#
+# Every tick is one fixed size record (see recordType()): the tick number, the
+# player's pose (x, y, theta), the enemies' positions and the sensor frame the
+# ANN got (Player.get_info()) going into the tick, and the commands (a wire.py
+# command mask) held during it.
+#
+# Records are buffered and appended to the log a chunk at a time:
+#
+#   header - HEADER: magic, version (uint16), observation size (uint16),
+#            number of enemies (uint32), records per chunk (uint32)
+#   chunk  - CHUNK: magic, first tick (uint64), number of records (uint32),
+#            then the records
+#
+# Each chunk written also appends an INDEX entry (first tick, file offset,
+# number of records) to '<log>.idx', so a reader can jump straight to the
+# chunk holding any tick. If the index is missing or behind (say, the
+# recorder was killed) it's rebuilt by hopping from chunk header to chunk
+# header, which never reads the records themselves.
+#
+#   $ python episodes.py run.log              # summary
+#   $ python episodes.py run.log --replay     # time streaming it back
+
+import bisect
+import os
+import struct
+import time
+
+import numpy
+
+MAGIC = 'WGEP'
+CHUNK_MAGIC = 'CHNK'
+VERSION = 1
+HEADER = struct.Struct('<4sHHII')
+CHUNK = struct.Struct('<4sQI')
+INDEX = struct.Struct('<QQI')
+
+CHUNK_TICKS = 1024
+
+def recordType(observation_size, num_enemies):
+    return numpy.dtype([
+        ('tick', '<u8'),
+        ('commands', '<u4'),
+        ('pose', '<f4', (3,)),
+        ('enemies', '<f4', (num_enemies, 2)),
+        ('observation', '<f4', (observation_size,)),
+    ])
+
+class EpisodeError(ValueError):
+    pass
+
+class Recorder(object):
+    """ Appends ticks to an episode log """
+
+    def __init__(self, path, observation_size, num_enemies, chunk_ticks=CHUNK_TICKS):
+        self.path = path
+        self.record_type = recordType(observation_size, num_enemies)
+        self.chunk_ticks = chunk_ticks
+        self.buffer = numpy.zeros(chunk_ticks, dtype=self.record_type)
+        self.count = 0
+        # Views of the buffer's fields (quicker to fill than a record at a time)
+        self.fields = [ self.buffer[name] for name in self.record_type.names ]
+
+        self.log = open(path, 'wb')
+        self.index = open(path + '.idx', 'wb')
+        self.log.write(HEADER.pack(MAGIC, VERSION, observation_size, num_enemies, chunk_ticks))
+
+    def record(self, tick, commands, pose, enemies, observation):
+        """ Add a tick. enemies is an (enemies x 2) array of their positions. """
+        ticks, command_masks, poses, enemy_positions, observations = self.fields
+        ticks[self.count] = tick
+        command_masks[self.count] = commands
+        poses[self.count] = pose
+        enemy_positions[self.count] = enemies
+        observations[self.count] = observation
+
+        self.count += 1
+        if self.count == self.chunk_ticks:
+            self.flush()
+
+    def flush(self):
+        """ Write out the buffered ticks as a chunk """
+        if not self.count:
+            return
+
+        records = self.buffer[:self.count]
+        offset = self.log.tell()
+        self.log.write(CHUNK.pack(CHUNK_MAGIC, int(records['tick'][0]), self.count))
+        self.log.write(records.tostring())
+        self.log.flush()
+
+        self.index.write(INDEX.pack(int(records['tick'][0]), offset, self.count))
+        self.index.flush()
+        self.count = 0
+
+    def close(self):
+        self.flush()
+        self.log.close()
+        self.index.close()
+
+class Episode(object):
+    """ Reads an episode log, in order or from any tick """
+
+    def __init__(self, path):
+        self.path = path
+        self.log = open(path, 'rb')
+
+        header = self.log.read(HEADER.size)
+        if len(header) != HEADER.size:
+            raise EpisodeError("{} is too short to be an episode log".format(path))
+        magic, version, observation_size, num_enemies, self.chunk_ticks = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise EpisodeError("{} is not an episode log".format(path))
+        if version != VERSION:
+            raise EpisodeError("{} is version {}, expected {}".format(path, version, VERSION))
+
+        self.observation_size = observation_size
+        self.num_enemies = num_enemies
+        self.record_type = recordType(observation_size, num_enemies)
+
+        # (first tick, offset, count) per chunk, and the first ticks for bisecting
+        self.chunks = self.loadIndex()
+        self.first_ticks = [ first for first, _, _ in self.chunks ]
+
+    def loadIndex(self):
+        chunks = []
+        try:
+            with open(self.path + '.idx', 'rb') as index:
+                data = index.read()
+            usable = len(data) - len(data) % INDEX.size
+            chunks = [ INDEX.unpack_from(data, start) for start in range(0, usable, INDEX.size) ]
+        except IOError:
+            pass
+
+        # Pick up any chunks the index doesn't have
+        offset = HEADER.size
+        if chunks:
+            _, last_offset, last_count = chunks[-1]
+            offset = last_offset + CHUNK.size + last_count * self.record_type.itemsize
+        return chunks + self.scanChunks(offset)
+
+    def scanChunks(self, offset):
+        """ Return (first tick, offset, count) of the whole chunks from offset on """
+        chunks = []
+        size = os.path.getsize(self.path)
+        while offset + CHUNK.size <= size:
+            self.log.seek(offset)
+            magic, first, count = CHUNK.unpack(self.log.read(CHUNK.size))
+            end = offset + CHUNK.size + count * self.record_type.itemsize
+            if magic != CHUNK_MAGIC or end > size:
+                break
+            chunks.append((first, offset, count))
+            offset = end
+        return chunks
+
+    def __len__(self):
+        return sum(count for _, _, count in self.chunks)
+
+    def readChunk(self, index):
+        _, offset, count = self.chunks[index]
+        self.log.seek(offset + CHUNK.size)
+        return numpy.fromfile(self.log, dtype=self.record_type, count=count)
+
+    def chunksFrom(self, tick):
+        """ Yield record arrays (whole chunks, the first one trimmed) starting at tick """
+        if not self.chunks:
+            return
+
+        index = max(bisect.bisect_right(self.first_ticks, tick) - 1, 0)
+        records = self.readChunk(index)
+        yield records[numpy.searchsorted(records['tick'], tick):]
+        for index in range(index + 1, len(self.chunks)):
+            yield self.readChunk(index)
+
+    def __iter__(self):
+        """ Yield every record in order """
+        for records in self.chunksFrom(0):
+            for record in records:
+                yield record
+
+    def seek(self, tick):
+        """ Return the record for tick (or the first one after it), or None """
+        for records in self.chunksFrom(tick):
+            if len(records):
+                return records[0]
+        return None
+
+    def read(self, start, stop):
+        """ Return the records for ticks start up to (not including) stop as one array """
+        parts = []
+        for records in self.chunksFrom(start):
+            parts.append(records[records['tick'] < stop])
+            if len(records) and records['tick'][-1] >= stop:
+                break
+        if not parts:
+            return numpy.zeros(0, dtype=self.record_type)
+        return numpy.concatenate(parts)
+
+    def close(self):
+        self.log.close()
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Look at an episode log')
+    parser.add_argument('path')
+    parser.add_argument('--replay', action='store_true', help='time streaming the whole log back')
+    args = parser.parse_args()
+
+    episode = Episode(args.path)
+    print "{}: {} ticks in {} chunks, {} bytes per tick ({} sensors, {} enemies)".format(
+        args.path, len(episode), len(episode.chunks), episode.record_type.itemsize,
+        episode.observation_size, episode.num_enemies)
+    if episode.chunks:
+        print "Ticks {} to {}".format(episode.first_ticks[0], episode.readChunk(-1)['tick'][-1])
+
+    if args.replay:
+        start = time.time()
+        ticks = sum(len(records) for records in episode.chunksFrom(0))
+        seconds = time.time() - start
+        print "Streamed {} ticks in {:.3f} s ({:.0f} ticks/s)".format(ticks, seconds, ticks / max(seconds, 1e-9))
+
+if __name__ == "__main__":
+    main()
+
+# vim:ts=4:sw=4:sta:et:
@@ -0,0 +1,238 @@
+# Neural Network
+# -- evolution.py
+#
+# @package NeuralNetwork
+
+# Neuroevolution: there are no targets for steering the player to the goal,
+# so instead of backpropagating, a population of networks is scored on how
+# well they drive a headless Simulation (by Player.cost_function()) and the
+# best ones breed the next generation.
+#
+# Episodes are run across a process pool, split into about as many chunks
+# as there are processes. Networks are never sent to the workers whole:
+#
+#   out  - the current elites' weights, plus a recipe per network to score,
+#          (parent a, parent b, seed): a fresh random network from the seed
+#          (no parents), a mutated copy of elite a (no parent b), or a
+#          crossover of elites a and b, then mutated
+#   back - the score of every network in the chunk, and the weights of only
+#          the chunk's best ELITE_COUNT (the only ones that can be elites)
+#
+# The elites carry over unchanged (and unscored, episodes are deterministic)
+# to the next generation.
+#
+#   $ python evolution.py --generations 50 --processes 4 --save best.wgnn
+
+import multiprocessing
+import time
+
+import numpy
+
+import sequential_nn
+import sim
+import wire
+
+POPULATION = 64
+# Networks kept unchanged each generation, the parents of all the others
+ELITE_COUNT = 8
+# Of the rest, how many are crossovers of two elites (the others are
+# mutated copies of one)
+CROSSOVER_FRACTION = .5
+# Chance of each weight being mutated, and the spread of what's added to it
+MUTATION_RATE = .1
+MUTATION_SCALE = .3
+EPISODE_TICKS = 600
+NUM_HIDDEN = 16
+ACTIVATION = 'tanh'
+# Chunks of the population per process (more balances uneven episodes
+# better, fewer sends the elites out fewer times)
+CHUNKS_PER_PROCESS = 2
+
+def randomWeights(layer_sizes, seed):
+    """ Return a fresh list of weight matrices, the same ones a
+        NeuralNetwork(layer_sizes, seed=seed) starts with
+    """
+    return [ sequential_nn.initWeights(num_nodes, num_edges, [ seed, index ])
+             for index, (num_nodes, num_edges) in enumerate(zip(layer_sizes[:-1], layer_sizes[1:])) ]
+
+def crossover(weights_a, weights_b, rand):
+    """ Return a child taking each neuron's (row's) weights from either parent """
+    child = []
+    for matrix_a, matrix_b in zip(weights_a, weights_b):
+        from_a = rand.random_sample(len(matrix_a)) < .5
+        child.append(numpy.where(from_a[:, None], matrix_a, matrix_b))
+    return child
+
+def mutate(weights, rand, rate=MUTATION_RATE, scale=MUTATION_SCALE):
+    """ Return a copy of weights with some of them nudged by gaussian noise """
+    mutated = []
+    for matrix in weights:
+        noise = rand.normal(0, scale, matrix.shape)
+        noise *= rand.random_sample(matrix.shape) < rate
+        mutated.append(matrix + noise)
+    return mutated
+
+def breed(recipe, elites, layer_sizes):
+    """ Return the weights a recipe (see the top of the file) describes """
+    parent_a, parent_b, seed = recipe
+    if parent_a is None:
+        return randomWeights(layer_sizes, seed)
+
+    rand = numpy.random.RandomState(seed)
+    weights = elites[parent_a]
+    if parent_b is not None:
+        weights = crossover(weights, elites[parent_b], rand)
+    return mutate(weights, rand)
+
+def network(weights, activation=ACTIVATION):
+    layers = [ sequential_nn.NumpyInnerLayer.fromWeights(matrix) for matrix in weights ]
+    for layer in layers:
+        layer.activation = sequential_nn.getActivation(activation)
+    return sequential_nn.NeuralNetwork.fromLayers(layers)
+
+def runEpisode(nn, ticks=EPISODE_TICKS):
+    """ Let the network drive a headless simulation for up to ticks and
+        return its fitness (higher is better)
+    """
+    simulation = sim.Simulation(headless=True)
+    player = simulation.game_map.player
+    scale = player.info_scale()
+
+    info = player.get_info()
+    for tick in xrange(ticks):
+        info = simulation.step(nn.feedForward(info * scale))
+        if player.reached_goal():
+            # Getting there sooner is better
+            return ticks - tick
+    return -player.cost_function()
+
+def evaluateChunk(task):
+    """ Score a chunk of recipes. Runs in the pool's workers.
+
+        Returns (the score of each recipe, [(score, weights)] of the best
+        keep of them).
+    """
+    elites, recipes, layer_sizes, ticks, keep = task
+    scored = []
+    for recipe in recipes:
+        weights = breed(recipe, elites, layer_sizes)
+        scored.append((runEpisode(network(weights), ticks), weights))
+
+    best = sorted(scored, key=lambda pair: pair[0], reverse=True)[:keep]
+    return [ score for score, _ in scored ], best
+
+def chunked(items, num_chunks):
+    size = -(-len(items) // max(num_chunks, 1))
+    return [ items[start:start + size] for start in range(0, len(items), size) ]
+
+class Population(object):
+    """ A population of networks evolved generation by generation """
+
+    def __init__(self, layer_sizes, size=POPULATION, elite_count=ELITE_COUNT,
+                 crossover_fraction=CROSSOVER_FRACTION, ticks=EPISODE_TICKS,
+                 processes=None, seed=None):
+        """ processes => worker processes to score with (None for one per
+                core, 1 to score in this process)
+        """
+        self.layer_sizes = layer_sizes
+        self.size = size
+        self.elite_count = min(elite_count, size)
+        self.crossover_fraction = crossover_fraction
+        self.ticks = ticks
+        self.rand = numpy.random.RandomState(seed)
+        self.generation = 0
+
+        # [(score, weights)], best first
+        self.elites = []
+        # The scores of the last generation scored (the elites included)
+        self.scores = []
+
+        self.processes = processes or multiprocessing.cpu_count()
+        self.pool = multiprocessing.Pool(self.processes) if self.processes > 1 else None
+
+    def newSeed(self):
+        return int(self.rand.randint(2 ** 31))
+
+    def recipes(self):
+        """ Return the recipes for the networks that need scoring this generation """
+        if not self.elites:
+            return [ (None, None, self.newSeed()) for i in range(self.size) ]
+
+        recipes = []
+        parents = len(self.elites)
+        for i in range(self.size - parents):
+            parent_a = self.rand.randint(parents)
+            parent_b = None
+            if parents > 1 and self.rand.random_sample() < self.crossover_fraction:
+                parent_b = self.rand.randint(parents)
+            recipes.append((parent_a, parent_b, self.newSeed()))
+        return recipes
+
+    def step(self):
+        """ Score a generation and pick its elites. Returns its scores. """
+        recipes = self.recipes()
+        elite_weights = [ weights for _, weights in self.elites ]
+        tasks = [ (elite_weights, chunk, self.layer_sizes, self.ticks, self.elite_count)
+                  for chunk in chunked(recipes, self.processes * CHUNKS_PER_PROCESS) ]
+
+        if self.pool:
+            results = self.pool.map(evaluateChunk, tasks)
+        else:
+            results = map(evaluateChunk, tasks)
+
+        # Only the elites and each chunk's best can be in the next elites
+        candidates = list(self.elites)
+        self.scores = [ score for score, _ in self.elites ]
+        for scores, best in results:
+            self.scores.extend(scores)
+            candidates.extend(best)
+
+        candidates.sort(key=lambda pair: pair[0], reverse=True)
+        self.elites = candidates[:self.elite_count]
+        self.generation += 1
+        return self.scores
+
+    def best(self):
+        """ Return the best network so far """
+        return network(self.elites[0][1])
+
+    def close(self):
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Evolve networks that steer the player to the goal')
+    parser.add_argument('--generations', type=int, default=20)
+    parser.add_argument('--population', type=int, default=POPULATION)
+    parser.add_argument('--elites', type=int, default=ELITE_COUNT, help='networks kept each generation')
+    parser.add_argument('--ticks', type=int, default=EPISODE_TICKS, help='longest an episode runs')
+    parser.add_argument('--hidden', type=int, default=NUM_HIDDEN, help='hidden layer size')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes (default: one per core)')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--save', help='checkpoint to write the best network to')
+    args = parser.parse_args()
+
+    num_inputs = len(sim.Simulation(headless=True).game_map.player.get_info())
+    population = Population([ num_inputs, args.hidden, len(wire.COMMANDS) ], args.population,
+                            args.elites, ticks=args.ticks, processes=args.processes, seed=args.seed)
+    try:
+        for generation in range(args.generations):
+            start = time.time()
+            scores = population.step()
+            seconds = time.time() - start
+            print "Generation {}: best {:.1f}, mean {:.1f}, {:.2f} s".format(
+                population.generation, max(scores), numpy.mean(scores), seconds)
+    finally:
+        population.close()
+
+    if args.save:
+        population.best().save(args.save)
+
+if __name__ == "__main__":
+    main()
+
+# vim:ts=4:sw=4:sta:et:
@@ -3,162 +3,154 @@
 #
 # @package NeuralNetwork
 
-import Queue
-import random
-import math
-import pickle
+import os
+
 import zmq
-import time
-import threading
 
-NUM_INPUTS = 3
+import sequential_nn
+import sim
+import wire
+
+# The number of inputs is however many sensors the simulation sends (see
+# Player.get_info)
 NUM_HIDDEN = 3
 NUM_OUTPUTS = 3
-OUTPUTS = []
-
-test_input = [ .0, .3, .6, .2, .8 ]
-
-class Node:
-
-    def __init__(self):
-        self.connected_edges = []
-
-    def sigmoid(self, num):
-        return math.tanh(num)
-
-class InputNode(Node):
-
-    def __init__(self):
-        self.input = Queue.Queue()
-
-class HiddenNode(Node):
-
-    def __init__(self):
-        self.values = []
-        self.final = 0
-        self.last_input = None
-
-    def activate(self):
-        sum = 0
-
-        for value in self.values:
-            sum += value
-
-        for value in self.values:
-            sum += value
-
-        return self.sigmoid(sum)
-
-class OutputNode(Node):
-
-    def __init__(self):
-        self.values = []
-
-    def checkThreshold(self):
-        sum = 0
-
-        for value in self.values:
-            sum += value
-
-        fin = self.sigmoid(sum)
-        if fin < 0.5:
-            return 0
+# What the network is trained towards on every frame for now
+TARGETS = [ 1, 0, 1 ]
+
+# The simulation connects with either a REQ socket (lockstep) or a DEALER
+# socket that keeps several sequence numbered frames in flight, so this end
+# is a ROUTER, which talks to both. Messages are in the wire.py format.
+ADDRESS = 'tcp://127.0.0.1:1235'
+SIM_ADDRESS = 'tcp://127.0.0.1:1234'
+# Only answer the newest frame waiting from each peer. The simulation treats
+# frames older than an answered one as dropped.
+CONFLATE = True
+# Frames answered between checkpoint saves (see serve)
+SAVE_EVERY = 1000
+
+def recvFrames(socket):
+    """ Wait for messages and return a list of (envelope, type, seq, payload)
+        for them, where the envelope is everything up to the empty delimiter
+        (to send back with the reply). Messages that aren't in the wire format
+        get an error reply right away, ones without a delimiter are dropped.
+    """
+    frames = []
+    while True:
+        message = socket.recv_multipart()
+        if '' not in message:
+            # No envelope to reply to, so just drop it
+            print "Bad message: no empty delimiter frame"
         else:
-            return 1
-
-def initEdgeWeights(nodes):
-    random.seed()
-
-    for node in nodes:
-        node.connected_edges = [ random.uniform(-1.0, 1.0) for x in range(NUM_INPUTS) ]
-
-def recvInputVector(input, input_nodes):
-    for i in range(NUM_INPUTS):
-        input_nodes[i].input.put(input[i])
-
-def derivSig(num):
-    return 1 - num**2
-
-def run(inputs, hidden, outputs):
-    for input in inputs:
-        val = input.input.get()
-
-        for i in range(NUM_HIDDEN):
-            hidden[i].values.append(input.connected_edges[i] * val)
-            hidden[i].last_input = val
-
-    for node in hidden:
-        node.final = node.activate()
-
-        for i in range(NUM_OUTPUTS):
-            outputs[i].values.append(node.connected_edges[i] * node.final)
-
-    for out in outputs:
-        OUTPUTS.append(out.checkThreshold())
-
-def backPropagate(targets, inputs, hidden):
-    out_deltas = []
-    for i in range(NUM_OUTPUTS):
-        error = targets[i] - OUTPUTS[i]
-        out_deltas.append(error * derivSig(OUTPUTS[i]))
-
-    for i in range(NUM_HIDDEN):
-        for j in range(NUM_OUTPUTS):
-            delta = out_deltas[j] * hidden[i].final
-            hidden[i].connected_edges[j] += .5 * delta
-
-    hidden_deltas = []
-    for i in range(NUM_HIDDEN):
-        error = 0
-        for j in range(NUM_OUTPUTS):
-            error += out_deltas[j] * hidden[i].connected_edges[j]
-        hidden_deltas.append(error * derivSig(hidden[i].final))
-
-    for i in range(NUM_INPUTS):
-        for j in range(NUM_HIDDEN):
-            delta = hidden_deltas[j] * hidden[i].last_input
-            inputs[i].connected_edges[j] += .5 * delta
-
-    error = 0
-    for i in range(len(targets)):
-        error += .5 * (targets[i] - OUTPUTS[i])**2
-
-    return error  
-
-def main():
-    # initialize all node objects
-    input_nodes = [ InputNode() for x in range(NUM_INPUTS) ]
-    hidden_nodes = [ HiddenNode() for x in range(NUM_HIDDEN) ]
-    output_nodes = [ OutputNode() for x in range(NUM_OUTPUTS) ]
-
-    # create the weights
-    initEdgeWeights(input_nodes)
-    initEdgeWeights(hidden_nodes)
+            delimiter = message.index('')
+            envelope = message[:delimiter + 1]
+            try:
+                # parse() only sees what follows the delimiter
+                frames.append((envelope,) + wire.parse(message[delimiter + 1:])[1:])
+            except wire.ProtocolError as e:
+                print "Bad message: {}".format(e)
+                wire.sendError(socket, 0, envelope)
+
+        if not socket.poll(0):
+            break
+
+    if not CONFLATE:
+        return frames
+
+    # Keep the newest frame from each peer
+    newest = {}
+    for frame in frames:
+        newest[frame[0][0]] = frame
+    return newest.values()
+
+def serve(checkpoint=None, save_every=SAVE_EVERY, train=True):
+    """ Answer the simulation's frames until interrupted
+
+        checkpoint => a NeuralNetwork checkpoint (e.g. from training.py or
+            evolution.py) to start from if it exists, and to save the network
+            to every save_every frames (0 for only on the way out)
+        train => keep training the network towards TARGETS on every frame
+            (without it, the checkpoint is never written)
+    """
+    # Without a checkpoint, the network is made once the first frame says
+    # how many inputs there are
+    nn = None
+    num_inputs = scale = None
+    if checkpoint and os.path.exists(checkpoint):
+        nn = sequential_nn.NeuralNetwork.load(checkpoint)
+        num_inputs = nn.layers[0].checkpointRecord()[3]
+        print "Loaded {} ({} inputs)".format(checkpoint, num_inputs)
+        if train and not all(layer.trainable for layer in nn.layers):
+            print "{} is inference only, not training it".format(checkpoint)
+            train = False
 
     # Start sending/receiving with the player (ANN)
     # create the server and the client for communication with Simulation.
     # server for receiving input from the simulation.
     context = zmq.Context()
-    socket = context.socket(zmq.REP)
-    socket.bind('tcp://127.0.0.1:1235')
-    socket.connect('tcp://127.0.0.1:1234')
+    socket = context.socket(zmq.ROUTER)
+    socket.bind(ADDRESS)
+    socket.connect(SIM_ADDRESS)
+
+    answered = 0
+    try:
+        while True:
+            for envelope, msg_type, seq, payload in recvFrames(socket):
+                if msg_type != wire.MSG_SENSORS or not len(payload):
+                    wire.sendError(socket, seq, envelope)
+                    continue
+
+                # A view of the message, scaled like training.py and
+                # evolution.py scale theirs (see sim.info_scale)
+                inputs = wire.sensors(payload)
+                if scale is None:
+                    if num_inputs is not None and len(inputs) != num_inputs:
+                        wire.sendError(socket, seq, envelope)
+                        continue
+                    try:
+                        scale = sim.info_scale(len(inputs))
+                    except ValueError as e:
+                        print "Bad sensors: {}".format(e)
+                        wire.sendError(socket, seq, envelope)
+                        continue
+                    num_inputs = len(inputs)
+                elif len(inputs) != num_inputs:
+                    wire.sendError(socket, seq, envelope)
+                    continue
+
+                if nn is None:
+                    nn = sequential_nn.NeuralNetwork([ num_inputs, NUM_HIDDEN, NUM_OUTPUTS ])
+
+                outputs = nn.feedForward(inputs * scale)
+                if train:
+                    nn.backPropagate(TARGETS)
+                wire.sendCommands(socket, seq, outputs, envelope)
+
+                answered += 1
+                if train and checkpoint and save_every and answered % save_every == 0:
+                    nn.save(checkpoint)
+    finally:
+        # Nothing to save if it isn't learning
+        if train and checkpoint and nn is not None:
+            nn.save(checkpoint)
+            print "Saved {} after {} frames".format(checkpoint, answered)
 
-    while True:
-        global OUTPUTS
-
-        new_inputs = socket.recv()
-        try:
-            new_inputs = pickle.loads(new_inputs)
-        except:
-            socket.send("SENT BAD DATA")
-
-        # initialize input nodes with newest data
-        recvInputVector(new_inputs, input_nodes)
-        run(input_nodes, hidden_nodes, output_nodes)
-        backPropagate([1, 0, 1], input_nodes, hidden_nodes)
-        #print OUTPUTS
-        socket.send(pickle.dumps(OUTPUTS))
-        OUTPUTS = []
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Drive the simulation with a network')
+    parser.add_argument('--checkpoint', metavar='PATH',
+                        help='network to start from if it exists, and to save to')
+    parser.add_argument('--save-every', type=int, default=SAVE_EVERY,
+                        help='frames between saves (0 for only on exit)')
+    parser.add_argument('--no-train', dest='train', action='store_false',
+                        help="just drive, don't keep training the network")
+    args = parser.parse_args()
+
+    try:
+        serve(args.checkpoint, args.save_every, args.train)
+    except KeyboardInterrupt:
+        pass
 
 if __name__ == "__main__":
     main()
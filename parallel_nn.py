@@ -32,7 +32,9 @@
 #
 # The parallel version uses java's concurrent classes. It makes a global
 # threadpool to handle tasks. Currently the activation of a layer is done in
-# parallel by making a new task for each "node" to be activated. Because all
+# parallel by splitting its nodes into one block of rows per thread and making
+# a task for each block (see rowBlocks). One task per node was much slower,
+# the scheduling overhead swamped the actual work. Because all
 # nodes in a layer must finish activating before moving on, it calls the .get()
 # method on all the futures returned by the threadpool's .invokeAll() method.
 # Because .get() on a Future is blocking until it has the value, this is like
@@ -40,12 +42,27 @@
 #
 # At the end of the program, the threadpool has to be shutdown or else the
 # program will not quit.
+#
+# ------------------------ NOTES ON THE CPYTHON VERSION ------------------------
+#
+# When java isn't available (i.e. running on regular CPython), threads are no
+# use because of the GIL, so "threadpool" is a ProcessPool instead: a fixed
+# set of worker processes that is started once in main() and kept around. The
+# layers are SharedInnerLayers, whose weight matrices live in shared memory
+# (multiprocessing RawArrays) that every worker maps when it starts. Tasks
+# only carry a layer number, a range of rows and the inputs, so the weights
+# are never pickled, and weight updates from backpropagation are seen by the
+# workers right away. Each layer's rows are split into blocks the same way as
+# on Java, and the inputs and outputs go through preallocated shared buffers
+# as well, so a task is just a handful of numbers.
 
 # ------------------------ NOTES TO DIEGO!!! ------------------------
 # I've included running the profiler as an option. I recommend it since it
 # will show the time taken to run various functions. In this file, one of
 # the "__init__" will take a long time because it creates a lot of values
-# with random which is slow. This should probably be disregarded. Essentially
+# with random which is slow (when NumPy is around, sequential_nn.initWeights
+# generates them in parallel chunks instead, which is quick). This should
+# probably be disregarded. Essentially
 # the only thing that matters is how long the various "activation" functions
 # take.
 #
@@ -62,6 +79,8 @@
 # Just be sure that the number of layers and the number of nodes in each layer
 # is the same in both "sequential_nn.py" and "parallel_nn.py". Triple check.
 # I've already made the mistake of them not being the same too many times...
+# (Or use benchmark.py, which builds every backend from the same spec and
+# sweeps the sizes and thread counts for you.)
 #
 # Last minute addition! I added "pipelining" as a parallelization technique. The idea
 # is that in the general use case, the neural network is ONLY feedforward (as in, if
@@ -70,12 +89,33 @@
 # the next feedforward operation as soon as you receive the input (i.e. from the game)
 # So you would have multiple feedforward operations happening at the same time! woo!
 # I tested, and, oddly, it seems like pipelining it is slower...
+#
+# Update: that version just threw NUM_TESTS whole feedForward calls at the same
+# threadpool, so they all fought over it. USE_PIPELINING now uses a real
+# pipeline (LayerPipeline): every layer is a stage with its own thread, and
+# the stages are linked by small bounded queues. Once it fills up, a new
+# output comes out every "slowest layer" worth of time, in the same order the
+# inputs went in, and if nobody takes the outputs the queues fill up and
+# whoever is feeding it inputs blocks (so the game can't outrun it).
 
 import random
-import math
 import threading
 import operator
-import java.util.concurrent
+import Queue
+
+try:
+    import java.util.concurrent
+    USE_JAVA = True
+except ImportError:
+    # Stock CPython, see the notes above
+    import multiprocessing
+    import multiprocessing.pool
+    import multiprocessing.sharedctypes
+    import numpy
+    USE_JAVA = False
+
+import sequential_nn
+import wire
 
 # Try doing tests with 3000+ input/hidden nodes (but only like 5 tests)
 # Also try doing it with less nodes but a lot more tests
@@ -88,6 +128,7 @@ NUM_HIDDEN = 1200
 NUM_OUTPUTS = 1
 LAYERS = [NUM_INPUTS, NUM_HIDDEN, NUM_OUTPUTS]
 USE_BACKPROPAGATE = False
+LEARNING_RATE = .5
 USE_PROFILE = True
 
 # These are the two "parallel" techniques
@@ -95,55 +136,51 @@ USE_PROFILE = True
 USE_PIPELINING = True
 USE_LOW_LEVEL_TASKS = True
 
-threadpool = java.util.concurrent.Executors.newFixedThreadPool(NUM_THREADS)
-
-class Layer(object):
-
-    def activate(self, inputs):
-        return inputs
-
-    @staticmethod
-    def sigmoid(num):
-        return math.tanh(num)
-
-    @staticmethod
-    def derivSig(num):
-        return 1 - math.tanh(num) ** 2
-
-class OutputLayer(Layer):
-
-    def activate(self, inputs):
-        return [ int(round(value / 2 + .5)) for value in inputs ]
-
-class InnerLayer(Layer):
-
-    def __init__(self, num_nodes, num_edges):
-        # A list of lists
-        # The rows correspond to the number of edges per node (number of nodes
-        # in the next layer).
-        # The columns correspond to the number of nodes in the current layer
-        self.weight_matrix = []
-
-        # Initialize the weights for each node
-        random.seed()
-        for row in range(num_edges):
-            self.weight_matrix.append([ random.uniform(-1.0, 1.0) for edge in range(num_nodes) ])
+# With USE_LOW_LEVEL_TASKS a layer is split into one block of contiguous rows
+# per worker (a multiple of TILE_ROWS rows), and each block is one task.
+# Inside a block, the NumPy workers go through the rows TILE_BYTES of weights
+# at a time so a tile stays in cache while a whole batch is multiplied by it.
+TILE_ROWS = 8
+TILE_BYTES = 256 * 1024
+# The number of inputs that can wait in front of each stage with USE_PIPELINING
+PIPELINE_DEPTH = 4
+# The CPython workers read inputs from and write outputs to shared buffers
+# with room for this many input vectors, bigger batches go through in slices
+MAX_BATCH = 64
+
+if USE_JAVA:
+    threadpool = java.util.concurrent.Executors.newFixedThreadPool(NUM_THREADS)
+else:
+    # The worker processes have to be started after the network's shared
+    # weights exist, so main() creates the ProcessPool
+    threadpool = None
+
+def rowBlocks(num_rows, num_workers=NUM_THREADS):
+    """ Split 'num_rows' rows into contiguous (start, stop) blocks, about
+        one per worker
+    """
+    block_rows = -(-num_rows // num_workers)
+    block_rows = -(-block_rows // TILE_ROWS) * TILE_ROWS
+    return [ (start, min(start + block_rows, num_rows)) for start in range(0, num_rows, block_rows) ]
+
+class InnerLayer(sequential_nn.InnerLayer):
 
     # TODO Parallelize this!
     def activate(self, inputs):
         """ Activate each neuron in the layer one at a time """
 
         if USE_LOW_LEVEL_TASKS:
+            # Every block writes its part of the outputs straight in here
             outputs = [ None ] * len(self.weight_matrix)
-            def activate_one_node(index, weights):
-                # This computes the dot product of two "vectors" (lists here)
-                dot_product = sum(map(operator.mul, inputs, weights))
-                output = self.sigmoid(dot_product)
-                outputs[index] = output
+            def activate_block(start, stop):
+                for index in range(start, stop):
+                    # This computes the dot product of two "vectors" (lists here)
+                    dot_product = sum(map(operator.mul, inputs, self.weight_matrix[index]))
+                    outputs[index] = self.sigmoid(dot_product)
 
             callables = []
-            for index, weights in enumerate(self.weight_matrix):
-                callables.append(MakeCallable(activate_one_node, index, weights))
+            for start, stop in rowBlocks(len(self.weight_matrix), NUM_THREADS):
+                callables.append(MakeCallable(activate_block, start, stop))
 
             futures = threadpool.invokeAll(callables)
             # It's like "join"ing
@@ -159,40 +196,247 @@ class InnerLayer(Layer):
 
         return outputs
 
-class MakeCallable(java.util.concurrent.Callable):
-
-    def __init__(self, fn, *args):
-        self.fn = fn
-        self.args = args
-
-    def call(self):
-        return self.fn(*self.args)
-
-class NeuralNetwork(object):
-
-    def __init__(self, nodes_per_layer):
-        self.layers = []
-        for num_nodes, num_edges in zip(nodes_per_layer[:-1], nodes_per_layer[1:]):
-            layer = InnerLayer(num_nodes, num_edges)
-            self.layers.append(layer)
-
-        output_layer = OutputLayer()
-        self.layers.append(output_layer)
-
-    def feedForward(self, inputs):
-        # Process the inputs layer by layer until we have the final output
-        for layer in self.layers:
-            outputs = layer.activate(inputs)
-            # Inputs to the next layer are outputs from the previous one
-            inputs = outputs
-
-        # 'outputs' is the output from the last layer...which is the output layer
+if USE_JAVA:
+    class MakeCallable(java.util.concurrent.Callable):
+
+        def __init__(self, fn, *args):
+            self.fn = fn
+            self.args = args
+
+        def call(self):
+            return self.fn(*self.args)
+
+else:
+    class SharedInnerLayer(sequential_nn.NumpyInnerLayer):
+
+        def __init__(self, num_nodes, num_edges, seed=None, scheme=sequential_nn.INIT_SCHEME):
+            super(SharedInnerLayer, self).__init__(num_nodes, num_edges, seed, scheme)
+            self.shareWeights()
+
+        @classmethod
+        def fromWeights(cls, weight_matrix):
+            # Used when loading a checkpoint
+            layer = super(SharedInnerLayer, cls).fromWeights(weight_matrix)
+            layer.shareWeights()
+            return layer
+
+        def shareWeights(self):
+            # Move the weights into shared memory. weight_matrix stays a NumPy
+            # array, it's just a view of the shared buffer now
+            num_edges, num_nodes = self.weight_matrix.shape
+            self.shared_weights = multiprocessing.sharedctypes.RawArray('d', num_edges * num_nodes)
+            weights = numpy.frombuffer(self.shared_weights).reshape(num_edges, num_nodes)
+            weights[:] = self.weight_matrix
+            self.weight_matrix = weights
+
+            # Set by the ProcessPool this layer is shared with
+            self.pool_index = None
+
+        def activate(self, inputs):
+            if USE_LOW_LEVEL_TASKS and threadpool is not None:
+                return threadpool.activate(self, inputs)
+            return super(SharedInnerLayer, self).activate(inputs)
+
+        def activateBatch(self, inputs):
+            if USE_LOW_LEVEL_TASKS and threadpool is not None:
+                return threadpool.activate(self, inputs)
+            return super(SharedInnerLayer, self).activateBatch(inputs)
+
+    # The (weights, inputs, outputs) shared arrays of the pool's layers, as
+    # mapped by a worker process
+    worker_layers = []
+
+    def sharedArray(shared, shape):
+        return numpy.frombuffer(shared).reshape(shape)
+
+    def initWorker(shared_layers):
+        """ Map the shared buffers, run once when a worker process starts """
+        global worker_layers
+        worker_layers = []
+        for weights, inputs, outputs, (num_edges, num_nodes) in shared_layers:
+            worker_layers.append((sharedArray(weights, (num_edges, num_nodes)),
+                                  sharedArray(inputs, (MAX_BATCH, num_nodes)),
+                                  sharedArray(outputs, (MAX_BATCH, num_edges))))
+
+    def activateBlock(task):
+        """ Activate rows [start, stop) of a layer for the first 'num_inputs'
+            rows of its shared input buffer, writing into its output buffer
+        """
+        layer_index, activation, num_inputs, start, stop = task
+        # By name in every task, so setActivation() after the pool started counts
+        activation = sequential_nn.ACTIVATIONS[activation]
+        weights, inputs, outputs = worker_layers[layer_index]
+        inputs = inputs[:num_inputs]
+
+        tile_rows = max(TILE_ROWS, TILE_BYTES // weights.itemsize // weights.shape[1])
+        for tile_start in range(start, stop, tile_rows):
+            tile_stop = min(tile_start + tile_rows, stop)
+            tile = weights[tile_start:tile_stop]
+            outputs[:num_inputs, tile_start:tile_stop] = activation.vectorized(numpy.dot(inputs, tile.T))
+
+    class ProcessPool(object):
+
+        def __init__(self, layers, num_workers=NUM_THREADS, threads=False):
+            self.num_workers = num_workers
+            self.layers = [ layer for layer in layers if isinstance(layer, SharedInnerLayer) ]
+
+            # Preallocated input/output buffers for each layer, so tasks are
+            # just a few numbers and the results never get pickled either
+            self.buffers = []
+            shared_layers = []
+            for index, layer in enumerate(self.layers):
+                layer.pool_index = index
+                num_edges, num_nodes = layer.weight_matrix.shape
+                inputs = multiprocessing.sharedctypes.RawArray('d', MAX_BATCH * num_nodes)
+                outputs = multiprocessing.sharedctypes.RawArray('d', MAX_BATCH * num_edges)
+                self.buffers.append((sharedArray(inputs, (MAX_BATCH, num_nodes)),
+                                     sharedArray(outputs, (MAX_BATCH, num_edges))))
+                shared_layers.append((layer.shared_weights, inputs, outputs, (num_edges, num_nodes)))
+
+            # The workers are forked, so they inherit the shared buffers
+            # rather than getting a pickled copy. With 'threads' the same
+            # tasks run on a thread pool instead (NumPy lets go of the GIL
+            # during the dot products), mostly for comparing the two.
+            pool_class = multiprocessing.pool.ThreadPool if threads else multiprocessing.Pool
+            self.pool = pool_class(num_workers, initializer=initWorker,
+                                   initargs=(shared_layers,))
+
+        def activate(self, layer, inputs):
+            """ Activate a layer (for one input or a batch) with one task per
+                block of rows
+            """
+            inputs = numpy.asarray(inputs, dtype=numpy.float64)
+            batch = inputs.reshape(-1, inputs.shape[-1])
+            shared_inputs, shared_outputs = self.buffers[layer.pool_index]
+            blocks = rowBlocks(len(layer.weight_matrix), self.num_workers)
+
+            outputs = numpy.empty((len(batch), len(layer.weight_matrix)))
+            for start in range(0, len(batch), MAX_BATCH):
+                rows = batch[start:start + MAX_BATCH]
+                shared_inputs[:len(rows)] = rows
+                tasks = [ (layer.pool_index, layer.activation.name, len(rows), block_start, block_stop)
+                          for block_start, block_stop in blocks ]
+                self.pool.map(activateBlock, tasks, chunksize=1)
+                # Copy out of the shared buffer, it is reused by the next call
+                outputs[start:start + len(rows)] = shared_outputs[:len(rows)]
+
+            return outputs.reshape(inputs.shape[:-1] + (len(layer.weight_matrix),))
+
+        def shutdown(self):
+            self.pool.close()
+            self.pool.join()
+
+class NeuralNetwork(sequential_nn.NeuralNetwork):
+
+    # Feed forward and backpropagation come from sequential_nn.py, only the
+    # layer activation is parallel here
+    inner_layer_class = InnerLayer if USE_JAVA else SharedInnerLayer
+
+    def __init__(self, nodes_per_layer, learning_rate=LEARNING_RATE,
+                 seed=sequential_nn.SEED, init_scheme=sequential_nn.INIT_SCHEME,
+                 activation=sequential_nn.ACTIVATION, approximate=sequential_nn.APPROXIMATE_ACTIVATION):
+        # Always build inner_layer_class layers. On Java those are the pure
+        # Python layers, on CPython the shared NumPy ones.
+        super(NeuralNetwork, self).__init__(nodes_per_layer, use_numpy=False,
+                                            learning_rate=learning_rate, seed=seed,
+                                            init_scheme=init_scheme, activation=activation,
+                                            approximate=approximate)
+
+    @classmethod
+    def load(cls, path, mmap_mode='c', learning_rate=LEARNING_RATE):
+        """ Make a network from a checkpoint (see sequential_nn.NeuralNetwork.load)
+            with inner_layer_class layers, like __init__ makes
+        """
+        nn = super(NeuralNetwork, cls).load(path, use_numpy=False, mmap_mode=mmap_mode,
+                                            learning_rate=learning_rate)
+        # Reduced precision and sparse layers would quietly run sequentially
+        for layer in nn.layers[:-1]:
+            if not isinstance(layer, cls.inner_layer_class):
+                raise ValueError("{} has a {}, only dense float64 layers run in parallel".format(
+                    path, type(layer).__name__))
+        return nn
+
+class LayerPipeline(object):
+
+    # Passed down the stages after the last input
+    DONE = object()
+
+    def __init__(self, nn, depth=PIPELINE_DEPTH):
+        # queues[i] feeds layer i, the last one holds the network's outputs
+        self.queues = [ Queue.Queue(depth) for i in range(len(nn.layers) + 1) ]
+
+        self.stages = []
+        for layer, inbox, outbox in zip(nn.layers, self.queues[:-1], self.queues[1:]):
+            stage = threading.Thread(target=self.runStage, args=(layer, inbox, outbox))
+            stage.daemon = True
+            stage.start()
+            self.stages.append(stage)
+
+    @classmethod
+    def runStage(cls, layer, inbox, outbox):
+        while True:
+            inputs = inbox.get()
+            if inputs is cls.DONE or isinstance(inputs, Exception):
+                outbox.put(inputs)
+                if inputs is cls.DONE:
+                    return
+                continue
+
+            try:
+                outbox.put(layer.activate(inputs))
+            except Exception as error:
+                # Hand it to whoever reads the outputs
+                outbox.put(error)
+
+    def put(self, inputs):
+        """ Queue an input, blocks while the first stage is backed up """
+        self.queues[0].put(inputs)
+
+    def get(self):
+        """ Return the outputs for the oldest input still in the pipeline """
+        outputs = self.queues[-1].get()
+        if isinstance(outputs, Exception):
+            raise outputs
         return outputs
 
-    def backPropagate(desired_outputs):
-        pass
+    def close(self):
+        """ Stop the stages once everything already queued is through """
+        self.queues[0].put(self.DONE)
+
+    def stream(self, inputs):
+        """ Feed every input from an iterable (e.g. a generator) through the
+            pipeline and yield the outputs in order
+        """
+        def feed():
+            try:
+                for item in inputs:
+                    self.put(item)
+            except Exception as error:
+                # Goes down the stages like any other error, get() raises it
+                self.put(error)
+            finally:
+                self.close()
+
+        feeder = threading.Thread(target=feed)
+        feeder.daemon = True
+        feeder.start()
+
+        while True:
+            outputs = self.get()
+            if outputs is self.DONE:
+                return
+            yield outputs
+
+def socketInputs(socket):
+    """ Yield input vectors as they arrive on a (zmq) socket in the wire.py format """
+    while True:
+        _, msg_type, seq, payload = wire.parse(socket.recv_multipart())
+        if msg_type == wire.MSG_SENSORS:
+            yield wire.sensors(payload)
 
 def main():
+    global threadpool
+
     # Test Data
     inputs = [ random.random() for i in range(NUM_INPUTS) ]
     desired_outputs = [ random.choice([0, 1]) for i in range(NUM_OUTPUTS) ]
@@ -201,20 +445,17 @@ def main():
 
     # initialize the neural network
     nn = NeuralNetwork(LAYERS)
+    if not USE_JAVA:
+        threadpool = ProcessPool(nn.layers, NUM_THREADS)
 
     if USE_PIPELINING:
         # The idea is that we can start processing the next set of
         # inputs from the game even before the old ones are finished.
         # So it's like a processor pipeline.
-        class NN_Runner(java.util.concurrent.Callable):
-            def __init__(self, i):
-                self.i = i
-            def call(self):
-                return (self.i, nn.feedForward(inputs))
-
-        output_futures = threadpool.invokeAll([ NN_Runner(i) for i in range(NUM_TESTS) ])
-        for i, future in enumerate(output_futures):
-            print "Test number {} -> ".format(i), future.get()
+        pipeline = LayerPipeline(nn)
+        outputs = pipeline.stream(inputs for i in range(NUM_TESTS))
+        for i, output in enumerate(outputs):
+            print "Test number {} -> ".format(i), output
     else:
         for i in range(NUM_TESTS):
             output = nn.feedForward(inputs)
@@ -232,33 +473,4 @@ if __name__ == "__main__":
     else:
         main()
 
-# def backPropagate(targets, inputs, hidden):
-#     out_deltas = []
-#     for i in range(NUM_OUTPUTS):
-#         error = targets[i] - OUTPUTS[i]
-#         out_deltas.append(error * derivSig(OUTPUTS[i]))
-#
-#     for i in range(NUM_HIDDEN):
-#         for j in range(NUM_OUTPUTS):
-#             delta = out_deltas[j] * hidden[i].final
-#             hidden[i].weights[j] += .5 * delta
-#
-#     hidden_deltas = []
-#     for i in range(NUM_HIDDEN):
-#         error = 0
-#         for j in range(NUM_OUTPUTS):
-#             error += out_deltas[j] * hidden[i].weights[j]
-#         hidden_deltas.append(error * derivSig(hidden[i].final))
-#
-#     for i in range(NUM_INPUTS):
-#         for j in range(NUM_HIDDEN):
-#             delta = hidden_deltas[j] * hidden[j].last_input
-#             inputs[i].weights[j] += .5 * delta
-#
-#     error = 0
-#     for i in range(len(targets)):
-#         error += .5 * (targets[i] - OUTPUTS[i])**2
-#
-#     return error
-
 # vim:ts=4:sw=4:sta:et:
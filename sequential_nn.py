@@ -7,6 +7,18 @@ import random
 import math
 import threading
 import operator
+import array
+import os
+import struct
+import sys
+import tempfile
+
+# NumPy is optional so that this module still imports under Jython (which
+# parallel_nn.py runs on). Without it, only the pure Python layers are used.
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 NUM_TESTS = 300
 NUM_INPUTS = 1000
@@ -14,39 +26,248 @@ NUM_HIDDEN = 1200
 NUM_OUTPUTS = 1
 LAYERS = [NUM_INPUTS, NUM_HIDDEN, NUM_OUTPUTS]
 USE_BACKPROPAGATE = False
+# Step size for the weight updates in backPropagate
+LEARNING_RATE = .5
 USE_PROFILE = True
+# Store each layer's weights in a single 2-D NumPy array and activate it with
+# one matrix-vector product instead of a Python loop per neuron
+USE_NUMPY = numpy is not None
+# Run all NUM_TESTS inputs through the network as one batch (one
+# matrix-matrix product per layer) rather than one feedForward per input
+USE_BATCH = True
+# Run main()'s batch through a copy of the network stored at lower precision
+# ('float32' or 'int8', see NeuralNetwork.quantized) and report how far its
+# outputs drift from the full precision ones. 'float64' leaves it alone.
+INFERENCE_PRECISION = 'float64'
+# The int8 layers widen their weights to float32 this many rows at a time, so
+# only int8 weights ever come from memory
+QUANTIZED_TILE_ROWS = 128
+# Fraction of the connections a new (randomly initialized) SparseInnerLayer
+# keeps for each node
+SPARSE_DENSITY = .1
+# The activation function of the inner layers (see ACTIVATIONS), and whether
+# to swap it for its fast approximation (if it has one) when speed matters
+# more than accuracy
+ACTIVATION = 'tanh'
+APPROXIMATE_ACTIVATION = False
+
+# Seed for the initial weights. None picks a new one every run (it's kept in
+# NeuralNetwork.seed so a run can still be repeated).
+SEED = None
+# How the initial weights are drawn, see initWeights
+INIT_SCHEME = 'uniform'
+# With NumPy, big layers are generated INIT_CHUNK_ROWS rows at a time on
+# INIT_THREADS threads. Every chunk has its own seeded stream, so the weights
+# don't depend on how many threads there are.
+INIT_CHUNK_ROWS = 256
+INIT_THREADS = 4
+
+# Checkpoint files (NeuralNetwork.save/load) are a small header followed by
+# the raw weight matrices. The header is:
+#   magic 'WGNN', format version (uint16), number of inner layers (uint16)
+#   then for each layer: kind (uint8), dtype (uint8), activation (uint16, see
+#   Activation.code), rows (uint32), columns (uint32) and the file offset of
+#   its weights (uint64)
+# Everything is little-endian, and every matrix is stored row by row starting
+# on a CHECKPOINT_ALIGNMENT byte boundary, so it can be memory mapped as is.
+#
+# Version 2 added the reduced precision dtypes, sparse layers and the
+# activation (version 1 files are all dense float64 tanh, so they still load).
+CHECKPOINT_MAGIC = 'WGNN'
+CHECKPOINT_VERSION = 2
+CHECKPOINT_ALIGNMENT = 64
+CHECKPOINT_HEADER = struct.Struct('<4sHH')
+CHECKPOINT_LAYER = struct.Struct('<BBHIIQ')
+# Layer kinds and dtypes in a checkpoint
+LAYER_DENSE = 0
+# A sparse layer's data starts with its number of weights (uint64), followed
+# by its CSR arrays: indptr (rows + 1 int64), indices (int32) and the weights
+# (float64, 8 byte aligned)
+LAYER_SPARSE = 1
+DTYPE_FLOAT64 = 0
+DTYPE_FLOAT32 = 1
+# int8 weights are followed by one float32 scale per row (4 byte aligned)
+DTYPE_INT8 = 2
+
+def weightLimit(scheme, num_nodes, num_edges):
+    """ Weights are drawn uniformly from [-limit, limit] """
+    if scheme == 'uniform':
+        return 1.0
+    elif scheme == 'xavier':
+        return math.sqrt(6.0 / (num_nodes + num_edges))
+    elif scheme == 'he':
+        return math.sqrt(6.0 / num_nodes)
+    else:
+        raise ValueError("Unknown init scheme: {}".format(scheme))
+
+def newSeed():
+    return random.SystemRandom().getrandbits(32)
+
+def initWeights(num_nodes, num_edges, seed, scheme=INIT_SCHEME):
+    """ Return a (num_edges x num_nodes) weight matrix
+
+        'seed' is a list of integers (e.g. [network seed, layer number]).
+        Returns a NumPy array if NumPy is around, otherwise a list of lists.
+    """
+    limit = weightLimit(scheme, num_nodes, num_edges)
+
+    if numpy is None:
+        rand = random.Random(tuple(seed))
+        return [ [ rand.uniform(-limit, limit) for edge in range(num_nodes) ] for row in range(num_edges) ]
+
+    weights = numpy.empty((num_edges, num_nodes))
+    chunk_starts = range(0, num_edges, INIT_CHUNK_ROWS)
+
+    def fill(chunk_indices):
+        for chunk_index in chunk_indices:
+            start = chunk_starts[chunk_index]
+            stop = min(start + INIT_CHUNK_ROWS, num_edges)
+            stream = numpy.random.RandomState(list(seed) + [ chunk_index ])
+            weights[start:stop] = stream.uniform(-limit, limit, (stop - start, num_nodes))
+
+    # NumPy doesn't hold the GIL while it generates the numbers
+    num_threads = max(1, min(INIT_THREADS, len(chunk_starts)))
+    threads = []
+    for offset in range(num_threads):
+        thread = threading.Thread(target=fill, args=(range(offset, len(chunk_starts), num_threads),))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    return weights
+
+class Activation(object):
+    """ An activation function for the inner layers
+
+        'function' works on a single number and 'vectorized' on a NumPy array.
+        'derivative' gives the slope from the function's *output*, which the
+        layers already have from the feed forward, so it never has to be
+        recomputed. Outputs go from 'low' to 'high' (the range the 0/1 targets
+        are scaled to), and the OutputLayer splits them in the middle. 'fast'
+        names a cheaper approximation of the same function.
+    """
+
+    def __init__(self, name, code, function, vectorized, derivative, low=-1.0, high=1.0, fast=None):
+        self.name = name
+        # Stored in checkpoints
+        self.code = code
+        self.function = function
+        self.vectorized = vectorized
+        self.derivative = derivative
+        self.low = low
+        self.high = high
+        self.threshold = (low + high) / 2
+        self.fast = fast
+
+def fastTanh(num):
+    """ Rational approximation of tanh, within .025 of it everywhere """
+    num = max(-3.0, min(3.0, num))
+    square = num * num
+    return num * (27 + square) / (27 + 9 * square)
+
+def fastTanhVectorized(values):
+    # The same as fastTanh, in place on as few temporaries as possible. It's
+    # about twice as fast as numpy.tanh.
+    values = numpy.clip(values, -3.0, 3.0)
+    squares = numpy.square(values)
+    numerators = squares + 27
+    numerators *= values
+    squares *= 9
+    squares += 27
+    numerators /= squares
+    return numerators
+
+ACTIVATIONS = {}
+
+def registerActivation(activation):
+    ACTIVATIONS[activation.name] = activation
+
+registerActivation(Activation('tanh', 0, math.tanh, lambda values: numpy.tanh(values),
+                              lambda outputs: 1 - outputs ** 2, fast='fast_tanh'))
+registerActivation(Activation('logistic', 1, lambda num: .5 * (1 + math.tanh(.5 * num)),
+                              lambda values: .5 * (1 + numpy.tanh(.5 * values)),
+                              lambda outputs: outputs * (1 - outputs), low=0.0))
+registerActivation(Activation('relu', 2, lambda num: max(0.0, num), lambda values: numpy.maximum(values, 0),
+                              lambda outputs: (outputs > 0) * 1.0, low=0.0))
+# The slope of the approximation is close enough to tanh's to train with
+registerActivation(Activation('fast_tanh', 3, fastTanh, fastTanhVectorized, lambda outputs: 1 - outputs ** 2))
+
+def getActivation(name, approximate=False):
+    """ Look up an activation by name, or its fast version with 'approximate' """
+    if name not in ACTIVATIONS:
+        raise ValueError("Unknown activation: {}".format(name))
+
+    activation = ACTIVATIONS[name]
+    if approximate and activation.fast:
+        activation = ACTIVATIONS[activation.fast]
+    return activation
+
+def activationForCode(code):
+    for activation in ACTIVATIONS.values():
+        if activation.code == code:
+            return activation
+    raise ValueError("Unknown activation code: {}".format(code))
 
 class Layer(object):
 
+    activation = ACTIVATIONS[ACTIVATION]
+    # False for layers that can only be used for inference
+    trainable = True
+
     def activate(self, inputs):
         return inputs
 
-    @staticmethod
-    def sigmoid(num):
-        return math.tanh(num)
+    def activateBatch(self, inputs):
+        """ Activate the layer for each row of 'inputs' """
+        if numpy is not None and isinstance(inputs, numpy.ndarray):
+            return inputs
+        return [ self.activate(row) for row in inputs ]
 
-    @staticmethod
-    def derivSig(num):
-        return 1 - math.tanh(num) ** 2
+    def backPropagate(self, inputs, outputs, errors, learning_rate):
+        """ Update the layer's weights from a mini-batch
+
+            'inputs' and 'outputs' are the rows this layer saw and produced
+            during the last feed forward, and 'errors' holds the (negative)
+            gradient of the loss with respect to each output. Returns the
+            errors with respect to the layer's inputs, for the layer before it.
+        """
+        return errors
+
+    def sigmoid(self, num):
+        return self.activation.function(num)
+
+    def derivSig(self, output):
+        """ The activation's slope, from its output """
+        return self.activation.derivative(output)
 
 class OutputLayer(Layer):
 
+    def __init__(self, threshold=0.0):
+        # The middle of the last inner layer's output range
+        self.threshold = threshold
+
     def activate(self, inputs):
-        return [ int(round(value / 2 + .5)) for value in inputs ]
+        return [ int(value >= self.threshold) for value in inputs ]
+
+    def activateBatch(self, inputs):
+        if numpy is not None and isinstance(inputs, numpy.ndarray):
+            # Threshold the whole batch in one go
+            return (inputs >= self.threshold).astype(int)
+        return super(OutputLayer, self).activateBatch(inputs)
 
 class InnerLayer(Layer):
 
-    def __init__(self, num_nodes, num_edges):
+    def __init__(self, num_nodes, num_edges, seed=None, scheme=INIT_SCHEME):
         # A list of lists
         # The rows correspond to the number of edges per node (number of nodes
         # in the next layer).
         # The columns correspond to the number of nodes in the current layer
-        self.weight_matrix = []
-
-        # Initialize the weights for each node
-        random.seed()
-        for row in range(num_edges):
-            self.weight_matrix.append([ random.uniform(-1.0, 1.0) for edge in range(num_nodes) ])
+        self.weight_matrix = initWeights(num_nodes, num_edges, seed or [ newSeed() ], scheme)
+        if numpy is not None:
+            # Generated with NumPy (same weights as a NumpyInnerLayer gets
+            # from the same seed), but this layer works on lists
+            self.weight_matrix = self.weight_matrix.tolist()
 
     # TODO Parallelize this!
     def activate(self, inputs):
@@ -60,29 +281,588 @@ class InnerLayer(Layer):
 
         return outputs
 
+    def backPropagate(self, inputs, outputs, errors, learning_rate):
+        deltas = [ [ error * self.derivSig(output) for error, output in zip(error_row, output_row) ]
+                   for error_row, output_row in zip(errors, outputs) ]
+
+        # Errors for the previous layer have to use the weights from before
+        # this update
+        columns = zip(*self.weight_matrix)
+        input_errors = [ [ sum(map(operator.mul, delta_row, column)) for column in columns ]
+                         for delta_row in deltas ]
+
+        # Average the weight gradient over the batch
+        scale = float(learning_rate) / len(inputs)
+        for row, weights in enumerate(self.weight_matrix):
+            for delta_row, input_row in zip(deltas, inputs):
+                step = scale * delta_row[row]
+                for index, value in enumerate(input_row):
+                    weights[index] += step * value
+
+        return input_errors
+
+    @classmethod
+    def fromWeights(cls, weight_matrix):
+        """ Make a layer around an existing weight matrix """
+        layer = cls.__new__(cls)
+        layer.weight_matrix = weight_matrix
+        return layer
+
+    def checkpointRecord(self):
+        """ Return (kind, dtype, rows, columns, size in bytes) for a checkpoint """
+        rows, columns = len(self.weight_matrix), len(self.weight_matrix[0])
+        return LAYER_DENSE, DTYPE_FLOAT64, rows, columns, rows * columns * 8
+
+    def writeWeights(self, checkpoint):
+        for weights in self.weight_matrix:
+            row = array.array('d', weights)
+            if sys.byteorder == 'big':
+                row.byteswap()
+            row.tofile(checkpoint)
+
+    @classmethod
+    def loadWeights(cls, path, rows, columns, offset, mmap_mode):
+        # Lists can't be memory mapped, so 'mmap_mode' is ignored here
+        values = array.array('d')
+        with open(path, 'rb') as checkpoint:
+            checkpoint.seek(offset)
+            values.fromfile(checkpoint, rows * columns)
+        if sys.byteorder == 'big':
+            values.byteswap()
+
+        return cls.fromWeights([ values[row * columns:(row + 1) * columns].tolist() for row in range(rows) ])
+
+class NumpyInnerLayer(InnerLayer):
+
+    def __init__(self, num_nodes, num_edges, seed=None, scheme=INIT_SCHEME):
+        # One contiguous (num_edges x num_nodes) array, drawn the same way as
+        # the pure Python layer's weights so both backends give the same results
+        self.weight_matrix = initWeights(num_nodes, num_edges, seed or [ newSeed() ], scheme)
+
+    def activate(self, inputs):
+        """ Activate every neuron in the layer with a single mat-vec """
+        return self.activation.vectorized(numpy.dot(self.weight_matrix, inputs))
+
+    def activateBatch(self, inputs):
+        """ Activate the layer for every input row with one mat-mat product """
+        return self.activation.vectorized(numpy.dot(inputs, self.weight_matrix.T))
+
+    def backPropagate(self, inputs, outputs, errors, learning_rate):
+        deltas = errors * self.activation.derivative(outputs)
+        input_errors = numpy.dot(deltas, self.weight_matrix)
+        # Update in place so anything sharing the weight buffer sees it
+        self.weight_matrix += (float(learning_rate) / len(inputs)) * numpy.dot(deltas.T, inputs)
+        return input_errors
+
+    # How the weights are stored in a checkpoint
+    checkpoint_dtype = DTYPE_FLOAT64
+    file_dtype = '<f8'
+
+    def checkpointRecord(self):
+        rows, columns = self.weight_matrix.shape
+        size = rows * columns * numpy.dtype(self.file_dtype).itemsize
+        return LAYER_DENSE, self.checkpoint_dtype, rows, columns, size
+
+    def writeWeights(self, checkpoint):
+        numpy.ascontiguousarray(self.weight_matrix, dtype=self.file_dtype).tofile(checkpoint)
+
+    @staticmethod
+    def loadArray(path, dtype, shape, offset, mmap_mode):
+        if mmap_mode:
+            return numpy.memmap(path, dtype=dtype, mode=mmap_mode, offset=offset, shape=shape)
+
+        with open(path, 'rb') as checkpoint:
+            checkpoint.seek(offset)
+            values = numpy.fromfile(checkpoint, dtype=dtype, count=numpy.prod(shape))
+        return values.reshape(shape)
+
+    @classmethod
+    def loadWeights(cls, path, rows, columns, offset, mmap_mode):
+        return cls.fromWeights(cls.loadArray(path, cls.file_dtype, (rows, columns), offset, mmap_mode))
+
+class Float32InnerLayer(NumpyInnerLayer):
+    """ A NumPy layer stored and computed in single precision (inference only) """
+
+    checkpoint_dtype = DTYPE_FLOAT32
+    file_dtype = '<f4'
+    trainable = False
+
+    @classmethod
+    def fromLayer(cls, layer):
+        return cls.fromWeights(numpy.asarray(layer.weight_matrix, dtype=numpy.float32))
+
+    def activate(self, inputs):
+        return self.activation.vectorized(numpy.dot(self.weight_matrix, numpy.asarray(inputs, dtype=numpy.float32)))
+
+    def activateBatch(self, inputs):
+        return self.activation.vectorized(numpy.dot(numpy.asarray(inputs, dtype=numpy.float32), self.weight_matrix.T))
+
+    def backPropagate(self, inputs, outputs, errors, learning_rate):
+        raise TypeError("{} is an inference-only layer".format(type(self).__name__))
+
+class Int8InnerLayer(NumpyInnerLayer):
+    """ A layer whose weights are int8, with a float32 scale for each row
+
+        Row i of the real weights is approximately weight_matrix[i] * scales[i].
+        Activations are computed in float32. Inference only.
+    """
+
+    checkpoint_dtype = DTYPE_INT8
+    file_dtype = 'i1'
+    trainable = False
+
+    @classmethod
+    def fromLayer(cls, layer):
+        weights = numpy.asarray(layer.weight_matrix, dtype=numpy.float64)
+        # Map the biggest weight in each row to +/-127
+        scales = numpy.abs(weights).max(axis=1) / 127
+        scales[scales == 0] = 1
+        quantized = numpy.round(weights / scales[:, numpy.newaxis]).astype(numpy.int8)
+        return cls.fromWeights(quantized, scales.astype(numpy.float32))
+
+    @classmethod
+    def fromWeights(cls, weight_matrix, scales):
+        layer = super(Int8InnerLayer, cls).fromWeights(weight_matrix)
+        layer.scales = scales
+        return layer
+
+    def activate(self, inputs):
+        return self.activateBatch(inputs)
+
+    def activateBatch(self, inputs):
+        inputs = numpy.asarray(inputs, dtype=numpy.float32)
+        rows = len(self.weight_matrix)
+        outputs = numpy.empty(inputs.shape[:-1] + (rows,), dtype=numpy.float32)
+        for start in range(0, rows, QUANTIZED_TILE_ROWS):
+            tile = self.weight_matrix[start:start + QUANTIZED_TILE_ROWS].astype(numpy.float32)
+            outputs[..., start:start + QUANTIZED_TILE_ROWS] = numpy.dot(inputs, tile.T)
+
+        outputs *= self.scales
+        return self.activation.vectorized(outputs)
+
+    def backPropagate(self, inputs, outputs, errors, learning_rate):
+        raise TypeError("{} is an inference-only layer".format(type(self).__name__))
+
+    @staticmethod
+    def scalesOffset(rows, columns):
+        return -(-rows * columns // 4) * 4
+
+    def checkpointRecord(self):
+        rows, columns = self.weight_matrix.shape
+        return LAYER_DENSE, DTYPE_INT8, rows, columns, self.scalesOffset(rows, columns) + rows * 4
+
+    def writeWeights(self, checkpoint):
+        rows, columns = self.weight_matrix.shape
+        numpy.ascontiguousarray(self.weight_matrix, dtype=self.file_dtype).tofile(checkpoint)
+        checkpoint.write('\0' * (self.scalesOffset(rows, columns) - rows * columns))
+        numpy.ascontiguousarray(self.scales, dtype='<f4').tofile(checkpoint)
+
+    @classmethod
+    def loadWeights(cls, path, rows, columns, offset, mmap_mode):
+        weights = cls.loadArray(path, cls.file_dtype, (rows, columns), offset, mmap_mode)
+        scales = cls.loadArray(path, '<f4', (rows,), offset + cls.scalesOffset(rows, columns), mmap_mode)
+        return cls.fromWeights(weights, scales)
+
+def segmentSum(values, starts, total):
+    """ Sum 'values' along its last axis in segments [starts[i], starts[i + 1])
+
+        Empty segments sum to 0, unlike with numpy.add.reduceat.
+    """
+    # Pad with a 0 so every start (even one equal to 'total') is a valid index
+    padded = numpy.concatenate([ values, numpy.zeros(values.shape[:-1] + (1,)) ], axis=-1)
+    sums = numpy.add.reduceat(padded, starts, axis=-1)
+    sums[..., starts == numpy.append(starts[1:], total)] = 0
+    return sums
+
+class SparseInnerLayer(NumpyInnerLayer):
+    """ A layer that only has some of its connections, stored CSR style
+
+        Row i's weights are data[indptr[i]:indptr[i + 1]], connecting to the
+        input nodes indices[indptr[i]:indptr[i + 1]]. Activating it and
+        training it costs time proportional to the number of connections.
+    """
+
+    def __init__(self, num_nodes, num_edges, seed=None, scheme=INIT_SCHEME, density=SPARSE_DENSITY):
+        # Connect every node in the next layer to a random subset of this one
+        stream = numpy.random.RandomState(list(seed or [ newSeed() ]))
+        limit = weightLimit(scheme, max(1, int(density * num_nodes)), num_edges)
+        per_row = max(1, int(round(density * num_nodes)))
+
+        indices = [ numpy.sort(stream.choice(num_nodes, per_row, replace=False)) for row in range(num_edges) ]
+        self.setWeights((num_edges, num_nodes),
+                        stream.uniform(-limit, limit, num_edges * per_row),
+                        numpy.concatenate(indices),
+                        numpy.arange(num_edges + 1) * per_row)
+
+    def setWeights(self, shape, data, indices, indptr):
+        self.shape = shape
+        self.data = numpy.asarray(data, dtype=numpy.float64)
+        self.indices = numpy.asarray(indices, dtype=numpy.int32)
+        self.indptr = numpy.asarray(indptr, dtype=numpy.int64)
+
+        # Which row every weight belongs to, and the weights grouped by
+        # column (for sending errors back to the inputs)
+        self.row_ids = numpy.repeat(numpy.arange(shape[0]), numpy.diff(self.indptr))
+        self.column_order = numpy.argsort(self.indices, kind='mergesort')
+        self.column_starts = numpy.searchsorted(self.indices[self.column_order], numpy.arange(shape[1]))
+
+    @classmethod
+    def fromArrays(cls, shape, data, indices, indptr):
+        layer = cls.__new__(cls)
+        layer.setWeights(shape, data, indices, indptr)
+        return layer
+
+    @classmethod
+    def fromLayer(cls, layer, fraction):
+        """ Magnitude pruning: drop the smallest 'fraction' of a dense layer's
+            weights and keep the rest as a sparse layer
+        """
+        weights = numpy.asarray(layer.weight_matrix, dtype=numpy.float64)
+        magnitudes = numpy.abs(weights)
+        threshold = numpy.percentile(magnitudes, 100.0 * fraction) if fraction > 0 else -1
+        rows, columns = numpy.nonzero(magnitudes > threshold)
+
+        indptr = numpy.zeros(weights.shape[0] + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(rows, minlength=weights.shape[0]), out=indptr[1:])
+        return cls.fromArrays(weights.shape, weights[rows, columns], columns, indptr)
+
+    @property
+    def density(self):
+        return float(len(self.data)) / (self.shape[0] * self.shape[1])
+
+    def activate(self, inputs):
+        return self.activateBatch(inputs)
+
+    def activateBatch(self, inputs):
+        inputs = numpy.asarray(inputs, dtype=numpy.float64)
+        products = inputs[..., self.indices] * self.data
+        return self.activation.vectorized(segmentSum(products, self.indptr[:-1], len(self.data)))
+
+    def backPropagate(self, inputs, outputs, errors, learning_rate):
+        deltas = errors * self.activation.derivative(outputs)
+
+        # Only the weights that exist get errors sent through them and
+        # get updated
+        contributions = deltas[:, self.row_ids] * self.data
+        input_errors = segmentSum(contributions[:, self.column_order], self.column_starts, len(self.data))
+
+        gradient = numpy.sum(deltas[:, self.row_ids] * inputs[:, self.indices], axis=0)
+        self.data += (float(learning_rate) / len(inputs)) * gradient
+        return input_errors
+
+    @staticmethod
+    def dataOffset(rows, nnz):
+        return -(-(8 + 8 * (rows + 1) + 4 * nnz) // 8) * 8
+
+    def checkpointRecord(self):
+        rows, columns = self.shape
+        return LAYER_SPARSE, DTYPE_FLOAT64, rows, columns, self.dataOffset(rows, len(self.data)) + 8 * len(self.data)
+
+    def writeWeights(self, checkpoint):
+        rows, columns = self.shape
+        checkpoint.write(struct.pack('<Q', len(self.data)))
+        numpy.ascontiguousarray(self.indptr, dtype='<i8').tofile(checkpoint)
+        numpy.ascontiguousarray(self.indices, dtype='<i4').tofile(checkpoint)
+        checkpoint.write('\0' * (self.dataOffset(rows, len(self.data)) - 8 - 8 * (rows + 1) - 4 * len(self.data)))
+        numpy.ascontiguousarray(self.data, dtype='<f8').tofile(checkpoint)
+
+    @classmethod
+    def loadWeights(cls, path, rows, columns, offset, mmap_mode):
+        with open(path, 'rb') as checkpoint:
+            checkpoint.seek(offset)
+            nnz, = struct.unpack('<Q', checkpoint.read(8))
+
+        indptr = cls.loadArray(path, '<i8', (rows + 1,), offset + 8, mmap_mode)
+        indices = cls.loadArray(path, '<i4', (nnz,), offset + 8 + 8 * (rows + 1), mmap_mode)
+        data = cls.loadArray(path, '<f8', (nnz,), offset + cls.dataOffset(rows, nnz), mmap_mode)
+        return cls.fromArrays((rows, columns), data, indices, indptr)
+
+# Layer classes for the reduced precision dtypes in a checkpoint or
+# NeuralNetwork.quantized
+REDUCED_PRECISION_LAYERS = {
+    DTYPE_FLOAT32: Float32InnerLayer,
+    DTYPE_INT8: Int8InnerLayer,
+}
+PRECISIONS = {
+    'float32': DTYPE_FLOAT32,
+    'int8': DTYPE_INT8,
+}
+
 class NeuralNetwork(object):
 
-    def __init__(self, nodes_per_layer):
+    # Layer type used when NumPy is off. parallel_nn.py swaps in its own.
+    inner_layer_class = InnerLayer
+
+    def __init__(self, nodes_per_layer, use_numpy=USE_NUMPY, learning_rate=LEARNING_RATE,
+                 seed=SEED, init_scheme=INIT_SCHEME, activation=ACTIVATION,
+                 approximate=APPROXIMATE_ACTIVATION):
+        if use_numpy and numpy is None:
+            raise ImportError("use_numpy requires NumPy to be installed")
+
+        self.seed = newSeed() if seed is None else seed
+        self.learning_rate = learning_rate
+        # The inputs to every layer (and the final outputs) from the last
+        # feed forward, kept around for backPropagate
+        self.activations = []
+        self.batched = False
+
+        layer_class = NumpyInnerLayer if use_numpy else self.inner_layer_class
         self.layers = []
-        for num_nodes, num_edges in nodes_per_layer[:-1], nodes_per_layer[1:]:
-            layer = InnerLayer(num_nodes, num_edges)
+        for index, (num_nodes, num_edges) in enumerate(zip(nodes_per_layer[:-1], nodes_per_layer[1:])):
+            # Every layer gets its own stream derived from the network's seed
+            layer = layer_class(num_nodes, num_edges, seed=[ self.seed, index ], scheme=init_scheme)
             self.layers.append(layer)
 
         output_layer = OutputLayer()
         self.layers.append(output_layer)
+        self.setActivation(activation, approximate)
+
+    def setActivation(self, name, approximate=False):
+        """ Use the activation 'name' in every inner layer, or its fast
+            approximation with 'approximate'
+        """
+        activation = getActivation(name, approximate)
+        for layer in self.layers[:-1]:
+            layer.activation = activation
+        self.layers[-1].threshold = activation.threshold
 
     def feedForward(self, inputs):
+        self.activations = [ inputs ]
+        self.batched = False
+
         # Process the inputs layer by layer until we have the final output
         for layer in self.layers:
             outputs = layer.activate(inputs)
+            self.activations.append(outputs)
             # Inputs to the next layer are outputs from the previous one
             inputs = outputs
 
         # 'outputs' is the output from the last layer...which is the output layer
         return outputs
 
-    def backPropagate(desired_outputs):
-        pass
+    def feedForwardBatch(self, matrix):
+        """ Feed N input vectors (the rows of 'matrix') through the network
+
+            Returns one row of outputs per input row. With NumPy layers each
+            layer does a single matrix-matrix product for the whole batch.
+        """
+        if numpy is not None and isinstance(self.layers[0], NumpyInnerLayer):
+            matrix = numpy.asarray(matrix, dtype=numpy.float64)
+
+        self.activations = [ matrix ]
+        self.batched = True
+
+        for layer in self.layers:
+            matrix = layer.activateBatch(matrix)
+            self.activations.append(matrix)
+
+        return matrix
+
+    def backPropagate(self, desired_outputs, learning_rate=None):
+        """ Train on the inputs from the last feedForward/feedForwardBatch
+
+            'desired_outputs' is a list of 0/1 targets, or one row of targets
+            per input row after feedForwardBatch. Returns the mean squared
+            error of the batch from before the update.
+        """
+        untrainable = [ type(layer).__name__ for layer in self.layers if not layer.trainable ]
+        if untrainable:
+            raise TypeError("Can't train a network with inference-only layers ({})".format(
+                ', '.join(untrainable)))
+
+        if learning_rate is None:
+            learning_rate = self.learning_rate
+
+        # Drop the thresholded outputs, rounding has no gradient
+        activations = self.activations[:-1]
+        final_activation = self.layers[-2].activation
+        low, scale = final_activation.low, final_activation.high - final_activation.low
+        use_numpy = numpy is not None and isinstance(activations[-1], numpy.ndarray)
+        if use_numpy:
+            activations = [ numpy.asarray(activation, dtype=numpy.float64) for activation in activations ]
+            targets = numpy.asarray(desired_outputs, dtype=numpy.float64)
+            if not self.batched:
+                activations = [ activation[numpy.newaxis] for activation in activations ]
+                targets = targets[numpy.newaxis]
+
+            # Compare the targets against the outputs scaled from the
+            # activation's range to [0, 1]
+            errors = targets - (activations[-1] - low) / scale
+            loss = .5 * numpy.sum(errors ** 2) / len(errors)
+            errors = errors / scale
+        else:
+            targets = desired_outputs
+            if not self.batched:
+                activations = [ [ activation ] for activation in activations ]
+                targets = [ targets ]
+
+            errors = [ [ target - (output - low) / scale for target, output in zip(target_row, output_row) ]
+                       for target_row, output_row in zip(targets, activations[-1]) ]
+            loss = .5 * sum(error ** 2 for row in errors for error in row) / len(errors)
+            errors = [ [ error / scale for error in row ] for row in errors ]
+
+        # Walk back through the inner layers, each one passing its input
+        # errors on to the layer before it
+        steps = zip(self.layers[:-1], activations[:-1], activations[1:])
+        for layer, inputs, outputs in reversed(steps):
+            errors = layer.backPropagate(inputs, outputs, errors, learning_rate)
+
+        return loss
+
+    def trainBatch(self, inputs, desired_outputs, learning_rate=None):
+        """ Run one mini-batch step: feed forward, then back propagate """
+        self.feedForwardBatch(inputs)
+        return self.backPropagate(desired_outputs, learning_rate)
+
+    def save(self, path):
+        """ Write the network's weights to a checkpoint file (see CHECKPOINT_*) """
+        inner_layers = self.layers[:-1]
+
+        # Work out where every layer's weights go first, the header has
+        # their offsets
+        records = []
+        offset = CHECKPOINT_HEADER.size + CHECKPOINT_LAYER.size * len(inner_layers)
+        for layer in inner_layers:
+            kind, dtype, rows, columns, size = layer.checkpointRecord()
+            offset = -(-offset // CHECKPOINT_ALIGNMENT) * CHECKPOINT_ALIGNMENT
+            records.append((kind, dtype, layer.activation.code, rows, columns, offset))
+            offset += size
+
+        # The weights may be memory mapped from 'path' itself (see load()), so
+        # write a new file next to it and swap it in when it's done
+        directory = os.path.dirname(os.path.abspath(path))
+        handle, temp_path = tempfile.mkstemp(prefix='.checkpoint', dir=directory)
+        try:
+            with os.fdopen(handle, 'wb') as checkpoint:
+                checkpoint.write(CHECKPOINT_HEADER.pack(CHECKPOINT_MAGIC, CHECKPOINT_VERSION, len(inner_layers)))
+                for record in records:
+                    checkpoint.write(CHECKPOINT_LAYER.pack(*record))
+
+                for layer, record in zip(inner_layers, records):
+                    checkpoint.write('\0' * (record[-1] - checkpoint.tell()))
+                    layer.writeWeights(checkpoint)
+                    checkpoint.flush()
+            # mkstemp makes it private, give it the mode open() would have
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(temp_path, 0666 & ~umask)
+            os.rename(temp_path, path)
+        except:
+            os.remove(temp_path)
+            raise
+
+    @classmethod
+    def load(cls, path, use_numpy=USE_NUMPY, mmap_mode='c', learning_rate=LEARNING_RATE):
+        """ Make a network from a checkpoint written by save()
+
+            With NumPy, the weights are memory mapped straight from the file
+            unless 'mmap_mode' is None, so even big networks load instantly
+            and processes loading the same file share its pages. The default
+            'c' (copy on write) still allows training; 'r' maps it read-only.
+        """
+        if use_numpy and numpy is None:
+            raise ImportError("use_numpy requires NumPy to be installed")
+
+        with open(path, 'rb') as checkpoint:
+            magic, version, num_layers = CHECKPOINT_HEADER.unpack(checkpoint.read(CHECKPOINT_HEADER.size))
+            if magic != CHECKPOINT_MAGIC:
+                raise ValueError("{} is not a network checkpoint".format(path))
+            if version > CHECKPOINT_VERSION:
+                raise ValueError("{} is checkpoint version {}, only up to {} is supported".format(
+                    path, version, CHECKPOINT_VERSION))
+
+            records = [ CHECKPOINT_LAYER.unpack(checkpoint.read(CHECKPOINT_LAYER.size))
+                        for i in range(num_layers) ]
+
+        layers = []
+        for kind, dtype, activation, rows, columns, offset in records:
+            if kind == LAYER_DENSE and dtype == DTYPE_FLOAT64:
+                layer_class = NumpyInnerLayer if use_numpy else cls.inner_layer_class
+            elif kind == LAYER_DENSE and dtype in REDUCED_PRECISION_LAYERS:
+                if numpy is None:
+                    raise ImportError("Loading reduced precision layers requires NumPy")
+                layer_class = REDUCED_PRECISION_LAYERS[dtype]
+            elif kind == LAYER_SPARSE and dtype == DTYPE_FLOAT64:
+                if numpy is None:
+                    raise ImportError("Loading sparse layers requires NumPy")
+                layer_class = SparseInnerLayer
+            else:
+                raise ValueError("{} has an unknown layer type ({}, {})".format(path, kind, dtype))
+            layer = layer_class.loadWeights(path, rows, columns, offset, mmap_mode)
+            layer.activation = activationForCode(activation)
+            layers.append(layer)
+
+        return cls.fromLayers(layers, learning_rate)
+
+    @classmethod
+    def fromLayers(cls, layers, learning_rate=LEARNING_RATE):
+        """ Make a network out of existing inner layers """
+        # Skip __init__, it would generate random weights just to throw them away
+        nn = cls.__new__(cls)
+        nn.seed = None
+        nn.learning_rate = learning_rate
+        nn.activations = []
+        nn.batched = False
+        nn.layers = list(layers) + [ OutputLayer(layers[-1].activation.threshold) ]
+        return nn
+
+    def quantized(self, precision):
+        """ Return a copy of the network for inference at lower precision,
+            'float32' or 'int8' (with a scale per row). Sparse layers are
+            kept as they are.
+        """
+        if precision not in PRECISIONS:
+            raise ValueError("Unknown precision: {}".format(precision))
+
+        layer_class = REDUCED_PRECISION_LAYERS[PRECISIONS[precision]]
+        layers = []
+        for layer in self.layers[:-1]:
+            if not isinstance(layer, SparseInnerLayer):
+                activation = layer.activation
+                layer = layer_class.fromLayer(layer)
+                layer.activation = activation
+            layers.append(layer)
+
+        return NeuralNetwork.fromLayers(layers, self.learning_rate)
+
+    def pruned(self, fraction, layer_indices=None):
+        """ Return a copy of the network with the smallest 'fraction' of the
+            weights in each dense layer (or just the layers in 'layer_indices')
+            removed, those layers becoming SparseInnerLayers
+        """
+        if numpy is None:
+            raise ImportError("Pruning requires NumPy")
+
+        layers = []
+        for index, layer in enumerate(self.layers[:-1]):
+            if isinstance(layer, SparseInnerLayer) or (layer_indices is not None and index not in layer_indices):
+                layers.append(layer)
+            else:
+                sparse_layer = SparseInnerLayer.fromLayer(layer, fraction)
+                sparse_layer.activation = layer.activation
+                layers.append(sparse_layer)
+
+        return NeuralNetwork.fromLayers(layers, self.learning_rate)
+
+    def accuracyDrift(self, reference, inputs):
+        """ Compare this network against 'reference' (e.g. the one it was
+            quantized from) on a batch of inputs
+
+            Returns a dict with the max and mean absolute difference of the
+            values going into the output layer, and the fraction of final
+            0/1 outputs that differ.
+        """
+        outputs = numpy.asarray(self.feedForwardBatch(inputs))
+        values = numpy.asarray(self.activations[-2], dtype=numpy.float64)
+        reference_outputs = numpy.asarray(reference.feedForwardBatch(inputs))
+        reference_values = numpy.asarray(reference.activations[-2], dtype=numpy.float64)
+
+        errors = numpy.abs(values - reference_values)
+        return {
+            'max_abs_error': float(errors.max()),
+            'mean_abs_error': float(errors.mean()),
+            'mismatch_rate': float(numpy.mean(outputs != reference_outputs)),
+        }
 
 def main():
     # Test Data
@@ -94,14 +874,24 @@ def main():
     # initialize the neural network
     nn = NeuralNetwork(LAYERS)
 
-    for i in range(NUM_TESTS):
-        # TODO: Call this in parallel?
-        # The idea is it's like a pipeline from the game
-        output = nn.feedForward(inputs)
-        if USE_BACKPROPAGATE:
-            error = nn.backPropagate(desired_outputs)
+    if INFERENCE_PRECISION != 'float64' and not USE_BACKPROPAGATE:
+        reference, nn = nn, nn.quantized(INFERENCE_PRECISION)
+        print "Drift at {}:".format(INFERENCE_PRECISION), nn.accuracyDrift(reference, [ inputs ])
+
+    if USE_BATCH and not USE_BACKPROPAGATE:
+        # Every test uses the same inputs, so stack them into one batch
+        outputs = nn.feedForwardBatch([ inputs ] * NUM_TESTS)
+        for i, output in enumerate(outputs):
+            print "Test number {} -> ".format(i), list(output)
+    else:
+        for i in range(NUM_TESTS):
+            # TODO: Call this in parallel?
+            # The idea is it's like a pipeline from the game
+            output = nn.feedForward(inputs)
+            if USE_BACKPROPAGATE:
+                error = nn.backPropagate(desired_outputs)
 
-        print "Test number {} -> ".format(i), output
+            print "Test number {} -> ".format(i), output
 
 if __name__ == "__main__":
     if USE_PROFILE:
@@ -110,33 +900,4 @@ if __name__ == "__main__":
     else:
         main()
 
-# def backPropagate(targets, inputs, hidden):
-#     out_deltas = []
-#     for i in range(NUM_OUTPUTS):
-#         error = targets[i] - OUTPUTS[i]
-#         out_deltas.append(error * derivSig(OUTPUTS[i]))
-#
-#     for i in range(NUM_HIDDEN):
-#         for j in range(NUM_OUTPUTS):
-#             delta = out_deltas[j] * hidden[i].final
-#             hidden[i].weights[j] += .5 * delta
-#
-#     hidden_deltas = []
-#     for i in range(NUM_HIDDEN):
-#         error = 0
-#         for j in range(NUM_OUTPUTS):
-#             error += out_deltas[j] * hidden[i].weights[j]
-#         hidden_deltas.append(error * derivSig(hidden[i].final))
-#
-#     for i in range(NUM_INPUTS):
-#         for j in range(NUM_HIDDEN):
-#             delta = hidden_deltas[j] * hidden[j].last_input
-#             inputs[i].weights[j] += .5 * delta
-#
-#     error = 0
-#     for i in range(len(targets)):
-#         error += .5 * (targets[i] - OUTPUTS[i])**2
-#
-#     return error
-
 # vim:ts=4:sw=4:sta:et:
@@ -2,7 +2,9 @@
 
 # Simulation for Neural Network
 
+import argparse
 import math
+import numpy
 import pygame
 import pygame.draw
 import random
@@ -10,7 +12,9 @@ import random
 import threading
 import time
 import zmq
-import pickle
+
+import episodes
+import wire
 
 from pygame.locals import *
 
@@ -39,7 +43,7 @@ from pygame.locals import *
 # For Thomas:
 # 	* [X] Consider alternative to add_objects() and super method draw/update -- I added a 'parent' parameter and a 'register' method
 # 	* [X] Collision detection on walls + enemies + player
-# 	* [/] Add feelers (wall/obstacle sensors) and radar (enemy sensor) to Player -- radar is done
+# 	* [X] Add feelers (wall/obstacle sensors) and radar (enemy sensor) to Player
 
 # Walls and enemy locations are hardcoded here for predictability
 WALLS = [
@@ -54,6 +58,54 @@ ENEMIES = [
 ]
 
 PLAYER_START = (350, 350)
+GOAL = (560, 40)
+# Size of the map (the part of the window the game is in)
+GAME_RESOLUTION = (640, 512)
+
+# Length of one tick of game time in seconds. Speeds are per tick, so this is
+# what they were tuned at (60 fps), whether or not anything is drawn.
+TIMESTEP = 1.0 / 60
+
+# mainloop() settings (see Simulation.mainloop)
+TICK_RATE = 60
+RENDER_RATE = 60
+RENDER_EVERY = 0
+MAX_CATCH_UP = 10
+
+# Smallest positive float, for dividing by distances that might be 0
+TINY = numpy.finfo(float).tiny
+
+# The player's feelers (see Player.set_feelers)
+FEELER_COUNT = 8
+FEELER_LENGTH = 100
+FEELER_FOV = math.pi
+
+# Side of a cell in the Map's wall grid (see SpatialGrid)
+GRID_CELL_SIZE = 64
+
+# What each collision with a wall adds to Player.cost_function() (a bump
+# costs about as much as the step it blocked)
+COLLISION_COST = 2.0
+
+# Connection to the ANN (nn.py), using the messages in wire.py. In lockstep
+# mode every frame waits for its reply (REQ/REP), so the ANN's round trip caps
+# how often the player gets new commands. In async mode (DEALER/ROUTER) frames
+# are numbered with the tick they were captured on and up to MAX_IN_FLIGHT of
+# them can be waiting on replies at once.
+SIM_ADDRESS = 'tcp://127.0.0.1:1234'
+ANN_ADDRESS = 'tcp://127.0.0.1:1235'
+USE_ASYNC = True
+MAX_IN_FLIGHT = 4
+# Give up on frames still unanswered after this many ticks (the reply was
+# lost, or the ANN restarted), so lost replies can't fill MAX_IN_FLIGHT
+IN_FLIGHT_EXPIRY = 30
+# Drop replies to frames older than one that's already been answered and only
+# apply the newest command of the replies that arrived together
+CONFLATE = True
+# How long to wait for replies (in ms) before checking for a new tick
+POLL_TIMEOUT = 5
+# Print the command lag every so many commands (0 to never print it)
+LAG_REPORT_INTERVAL = 300
 
 class Color(pygame.Color):
 	white = pygame.Color(255, 255, 255)
@@ -65,6 +117,10 @@ class Color(pygame.Color):
 
 class GameObject(object):
 
+	# Static objects never change how they look, so Map draws them once into
+	# its cached background instead of every frame
+	static = False
+
 	def __init__(self, parent, position=(0, 0), dimension=(0, 0), *args, **kwargs):
 		super(GameObject, self).__init__(*args, **kwargs)
 
@@ -85,8 +141,11 @@ class GameObject(object):
 			obj.update()
 
 	def draw(self, surface):
+		""" Draw the object (and its children) and return a list of the rects drawn on """
+		dirty = []
 		for obj in self.objects:
-			obj.draw(surface)
+			dirty.extend(obj.draw(surface))
+		return dirty
 
 	def notify(self, *args, **kwargs):
 		print args
@@ -152,15 +211,21 @@ class Enemy(GameObject):
 		self.radius = radius
 		self.game_map = parent
 		self.speed = Enemy.speed
-		self.detected = False
+		# Where this enemy's rect is in the Map's enemy arrays
+		self.index = None
 
 	def draw(self, surface):
 		color = Color.red if not self.detected else Color.green
-		pygame.draw.circle(surface, color, self.rect.topleft, self.radius)
+		return [pygame.draw.circle(surface, color, self.rect.topleft, self.radius)]
 
 	def update(self):
 		screen_width = self.parent.rect.width
 		self.rect.centerx = (self.rect.centerx + self.speed) % screen_width
+		self.parent.enemy_rects[self.index, 0] = self.rect.x
+
+	@property
+	def detected(self):
+		return self.parent.detected[self.index]
 
 class StaticEnemy(Enemy):
 
@@ -212,122 +277,77 @@ class Vector(object):
 
 		return Vector(x, y)
 
-class Line(object):
-
-	def __init__(self, m=float("inf"), b=None, x=None):
-		self.m = m
-		self.b = b
-		self._x = x
-
-	@property
-	def x(self):
-		if _x is not None:
-			return _x
-		else:
-			return -(self.b / self.m)
-
-	@classmethod
-	def vertical(cls, x):
-		return cls(x=x)
-
-	@classmethod
-	def from_points(cls, p1, p2):
-		if p1[0] == p2[0]:
-			return cls.vertical(p1[0])
-
-		m = (p1[1] - p2[1]) / (p1[0] - p2[0])
-		b = p1[1] - (m * p1[0])
-		return cls(m=m, b=b)
-
-	@classmethod
-	def from_vectors(cls, v1, v2):
-		return cls.from_points((v1.x, v1.y), (v2.x, v2.y))
-
-	def is_vertical(self):
-		return self.m == float("inf")
-
-	def parallels(self, line):
-		return self.m == line.m
-
-	def same_as(self, line):
-		if self.parallels(line):
-			if self.is_vertical():
-				return self.x == line.y
-			else:
-				return self.b == line.b
-		else:
-			return False
-
-	def intersects(self, line):
-		""" 	If there is only one point of intersection, return that point
-			as a tuple.
-
-			If there are no points of intersection (parallel but not the same),
-			return False
-
-			If they are the same line, return True
-		"""
-		if self.parallels(line):
-			return self.same_as(line)
-		else:
-			if self.is_vertical():
-				return (self.x, (line.m * self.x) + line.b)
-			elif line.is_vertical():
-				return (line.x, (self.m * line.x) + self.b)
-			else:
-				x = (line.b - self.b) / (self.m - line.m)
-				y = (self.m * x) + self.b
-				return (x, y)
-
-class Feeler(Vector):
-
-	def __init__(self, x, y):
-		super(Feeler, self).__init__(x, y)
-
-	def distance_to_wall(self, wall, player_vector):
-		r1 = wall.rect.topleft
-		r2 = wall.rect.topright
-		r3 = wall.rect.bottomright
-		r4 = wall.rect.bottomleft
-
-		l1 = (r1, r2)
-		l2 = (r2, r3)
-		l3 = (r3, r4)
-		l4 = (r4, r1)
-
-		feeler_vector = self.rotated(player.theta)
-		feeler_line = Line.from_vectors(player_vector, feeler_vector)
-
-		minimum = self.magnitude
-		for points in [l1, l2, l3, l4]:
-			p1, p2 = points
-			line = Line.from_points(p1, p2)
-			intersection = feeler_line.intersects(line)
-			if intersection:
-				if intersection is True:
-					# Minimum distance from the player to the wall (that is, the magnitude).
-					# Because the player can only be on one side or the other of the wall,
-					# not in it, we only need to see which point it's closest to.
-					return min(map(abs, [player_vector.y - p1, player_vector.y - p2]))
-				else:
-					# Record the minimum intersection distance.
-					distance_vector = player_vector - Vector(*intersection)
-					# Test if the intersection lies between the two points of the
-					# rectangle making the line segment
-					if is_bound(intersection, p1, p2):
-						minimum = min(minimum, distance_vector.magnitude)
-
-		return minimum
-
-
-	def closest_intersect(self, player, walls):
-		player_vector = Vector(player.centerx, player.y)
-
-		minimum = self.magnitude
-		for wall in walls:
-			minimum = min(minimum, self.distance_to_wall(wall, player_vector))
-
-		return minimum
+def radar_hits(x, y, enemy_rects, radius, out=None):
+	""" 	Return a mask of the enemies picked up by a radar at (x, y)
+
+		enemy_rects => the enemies' rects as rows of (x, y, width, height)
+		radius => how far the radar reaches
+
+		The radar looks radius towards each enemy's center (or at the center if
+		it's closer) and picks the enemy up if that point is in its rect, like
+		collidepoint() with the point truncated to a pixel. x and y can also be
+		arrays that broadcast against enemy_rects[..., 0] (one row per world, as in
+		batch_env.py).
+	"""
+	left, top = enemy_rects[..., 0], enemy_rects[..., 1]
+	width, height = enemy_rects[..., 2], enemy_rects[..., 3]
+	dx = left + width // 2 - x
+	dy = top + height // 2 - y
+	distance = numpy.hypot(dx, dy)
+
+	# An enemy right on the radar has no direction (the scale comes out as 0),
+	# but it's certainly seen
+	scale = numpy.minimum(radius, distance)
+	scale /= numpy.maximum(distance, TINY)
+	point_x = numpy.trunc(x + dx * scale)
+	point_y = numpy.trunc(y + dy * scale)
+
+	hits = (point_x >= left) & (point_x < left + width) & (point_y >= top) & (point_y < top + height)
+	if out is None:
+		return hits
+	out[...] = hits
+	return out
+
+def cast_rays(x, y, angles, length, rects, out=None):
+	""" 	Return how far each ray from (x, y) gets before it hits a rect, or
+		length if it doesn't hit one within that
+
+		angles => the rays' directions in radians
+		rects => rows of (x, y, width, height)
+
+		For many worlds at once (as in batch_env.py) give angles a row per world,
+		rects a (worlds x rects x 4) array and x, y arrays shaped (worlds, 1, 1).
+
+		Every ray is tested against every rect at once with the slab test: a ray
+		is in a rect between where it enters both its x and y ranges and where it
+		leaves the first of them. Rays starting inside a rect get 0.
+	"""
+	distances = numpy.empty(numpy.shape(angles)) if out is None else out
+	if not rects.shape[-2]:
+		distances[...] = length
+		return distances
+
+	# Rays along the rows, rects along the columns
+	dir_x = numpy.cos(angles)[..., None]
+	dir_y = numpy.sin(angles)[..., None]
+	left, top = rects[..., None, :, 0], rects[..., None, :, 1]
+	right, bottom = left + rects[..., None, :, 2], top + rects[..., None, :, 3]
+
+	# A ray parallel to an axis divides by 0 and gets infinities (it's in that
+	# slab either always or never) or NaNs on the slab's edge, which fmin and
+	# fmax skip over
+	with numpy.errstate(divide='ignore', invalid='ignore'):
+		inv_x = 1 / dir_x
+		inv_y = 1 / dir_y
+		near_x, far_x = (left - x) * inv_x, (right - x) * inv_x
+		near_y, far_y = (top - y) * inv_y, (bottom - y) * inv_y
+	enter = numpy.fmax(numpy.fmin(near_x, far_x), numpy.fmin(near_y, far_y))
+	leave = numpy.fmin(numpy.fmax(near_x, far_x), numpy.fmax(near_y, far_y))
+	enter = numpy.maximum(enter, 0)
+
+	hits = numpy.where(leave >= enter, enter, length)
+	numpy.minimum(hits.min(axis=-1), length, out=distances)
+	return distances
 
 def bound(value, maximum, minimum):
 	if maximum < minimum:
@@ -339,8 +359,45 @@ def is_bound(value, maximum, minimum):
 		maximum, minimum = minimum, maximum
 	return minimum <= value <= maximum
 
+def info_layout(feeler_count, num_enemies):
+	""" Return [(field, size)] in the order Player.get_info() lays them out """
+	return [
+		('pose', 2),
+		('heading', 2),
+		('feelers', feeler_count),
+		('radar', num_enemies),
+		('goal', 2),
+	]
+
+def info_scale(size, feeler_count=FEELER_COUNT, feeler_length=FEELER_LENGTH, dimension=GAME_RESOLUTION):
+	""" 	Return what to multiply a get_info() frame of size values by to bring
+		every sensor to about [-1, 1], so positions and feeler lengths don't
+		swamp the rest (or saturate tanh layers). Whatever feeds frames to a
+		network (nn.py, training.py, evolution.py) scales them with this, so
+		their checkpoints all expect the same inputs.
+	"""
+	# The radar has one value per enemy, whatever's left over
+	fixed = sum(count for field, count in info_layout(feeler_count, 0))
+	num_enemies = size - fixed
+	if num_enemies < 0:
+		raise ValueError("A frame with {} feelers has at least {} values, not {}".format(feeler_count, fixed, size))
+
+	scales = []
+	for field, count in info_layout(feeler_count, num_enemies):
+		if field == 'pose':
+			scales.extend(1.0 / value for value in dimension)
+		elif field == 'feelers':
+			scales.extend([1.0 / feeler_length] * count)
+		else:
+			scales.extend([1.0] * count)
+	return numpy.array(scales, dtype=numpy.float32)
+
 class Player(GameObject):
 
+	speed = 2
+	rotation_speed = .06
+	radar_radius = 75
+
 	def __init__(self, parent, position, radius=10):
 		super(Player, self).__init__(parent, position, dimension=(2 * radius, 2 * radius))
 		self.radius = radius
@@ -350,81 +407,95 @@ class Player(GameObject):
 		self.move_forward = False
 
 		self.x, self.y = position
-		self.speed = 2
-		self.rotation_speed = .06
+		self.speed = Player.speed
+		self.rotation_speed = Player.rotation_speed
 		# Start facing to the top of the screen. 0 degrees points to the right
 		self.theta = math.pi
 
-		self.radar_radius = 75
+		self.radar_radius = Player.radar_radius
+		self._radar_overlay = None
+		self.set_feelers()
 
-	def feelers(self, count=3, length=100, fov=math.pi):
-		"""  Return a list of Feeler objects
+		# Number of updates so far (sensor frames are numbered with it)
+		self.ticks = 0
+		self.collisions = 0
+		# Print collisions (headless runs turn this off)
+		self.verbose = True
+		# (tick, copy of get_info()) for the connection thread, see publish_frame()
+		self.frame = None
 
-			count => the number of feelers to create
-			length => the length of the feeler (how far it can detect objects)
-			fov => field of view, or the range in radians that the feelers fan across
+	def set_feelers(self, count=FEELER_COUNT, length=FEELER_LENGTH, fov=FEELER_FOV):
+		""" 	Set up the feelers (wall sensors)
 
-			returns a list of Feelers
+			count => the number of feelers
+			length => the length of the feelers (how far they can detect walls)
+			fov => field of view, or the range in radians that the feelers fan across
 		"""
-		feelers = []
-
-		start_angle = (self.theta - (fov / 2)) % (math.pi * 2)
-		spread = (fov / count)
-		for i in range(count):
-			angle = start_angle + (spread * i) % (math.pi * 2)
-			x = (math.cos(angle) * length)
-			y = (math.sin(angle) * length)
-			feeler = Feeler(x, y)
-			feelers.append(feeler)
-
-		return feelers
+		self.feeler_length = length
+		# Angles from the player's heading, spread evenly across the fov
+		self.feeler_offsets = (numpy.arange(count) + .5) * (fov / count) - fov / 2
+		self.feeler_distances = numpy.empty(count)
+		self.feelers()
 
+		# get_info()'s buffer depends on the number of feelers
+		self.info = numpy.zeros(sum(size for _, size in self.info_layout()), dtype=numpy.float32)
 
-	def radar(self, radius):
-		radar_list = []
-		for enemy in self.parent.enemies:
-			player_pos = Vector(*self.rect.center)
-			enemy_pos = Vector(*enemy.rect.center)
-			vector = enemy_pos - player_pos
+	def feelers(self):
+		""" Cast the feelers and return how far each one is from a wall """
+		game_map = self.parent
+		x, y = self.rect.center
 
-			max_distance = min(radius, vector.magnitude)
-			direction = vector.normalized()
-			closest_point = player_pos + Vector(direction.x * max_distance, direction.y * max_distance)
+		# Only the walls within reach of the feelers
+		area = pygame.Rect(0, 0, 2 * self.feeler_length + 3, 2 * self.feeler_length + 3)
+		area.center = self.rect.center
+		nearby = [ wall.index for wall in game_map.wall_grid.query(area) ]
 
-			if enemy.rect.collidepoint(closest_point.to_point()):
-				radar_list.append(enemy)
+		return cast_rays(x, y, self.theta + self.feeler_offsets, self.feeler_length,
+			game_map.wall_rects[nearby], out=self.feeler_distances)
 
-		return radar_list
+	def radar(self, radius):
+		""" Return a mask of which of the map's enemies the radar picks up """
+		game_map = self.parent
+		x, y = self.rect.center
+		return radar_hits(x, y, game_map.enemy_rects, radius, out=game_map.detected)
+
+	def radar_overlay(self):
+		""" Return the (cached) translucent circle drawn for the radar """
+		if self._radar_overlay is None or self._radar_overlay.get_width() != 2 * self.radar_radius + 1:
+			radar_color = pygame.Color(50, 50, 50, 50)
+			size = 2 * self.radar_radius + 1
+			self._radar_overlay = pygame.Surface((size, size), SRCALPHA, 32)
+			self._radar_overlay.fill((0, 0, 0, 0))
+			pygame.draw.circle(self._radar_overlay, radar_color, (self.radar_radius, self.radar_radius), self.radar_radius)
+
+		return self._radar_overlay
 
 	def draw(self, surface):
 		# ----- Draw the radar -----
-		radar_color = pygame.Color(50, 50, 50)
-		radar_surface = pygame.Surface(surface.get_size())
-		radar_surface.fill((255, 255, 255))
-		pygame.draw.circle(radar_surface, radar_color, self.rect.center, self.radar_radius)
-		radar_surface.set_alpha(50)
-		surface.blit(radar_surface, (0, 0))
+		overlay = self.radar_overlay()
+		overlay_rect = overlay.get_rect(center=self.rect.center)
+		dirty = [surface.blit(overlay, overlay_rect)]
 
 		# ----- Draw the feelers -----
-		# TODO
-		for feeler in self.feelers:
-			pass
+		feeler_color = pygame.Color(150, 150, 150)
+		center_x, center_y = self.rect.center
+		feeler_rects = []
+		for offset, distance in zip(self.feeler_offsets, self.feeler_distances):
+			angle = self.theta + offset
+			end = (center_x + distance * math.cos(angle), center_y + distance * math.sin(angle))
+			color = Color.red if distance < self.feeler_length else feeler_color
+			feeler_rects.append(pygame.draw.line(surface, color, self.rect.center, end))
+		if feeler_rects:
+			dirty.append(feeler_rects[0].unionall(feeler_rects[1:]))
 
 		# ----- Draw the player -----
 		# When this is changed to use an image instead of a circle, rotate the image
-		pygame.draw.circle(surface, Color.blue, self.rect.center, self.radius)
+		dirty.append(pygame.draw.circle(surface, Color.blue, self.rect.center, self.radius))
 		# pygame.draw.rect(surface, Color.yellow, self.rect)
+		return dirty
 
 	def update(self):
-		# Update the radar
-		for enemy in self.parent.enemies:
-			enemy.detected = False
-		detected_enemies = self.radar(self.radar_radius)
-		for enemy in detected_enemies:
-			enemy.detected = True
-
-		# Update the feelers
-		# TODO
+		self.ticks += 1
 
 		if self.move_forward:
 			self.go_forward()
@@ -435,6 +506,15 @@ class Player(GameObject):
 		if self.turn_right:
 			self.theta += self.rotation_speed % (2 * math.pi)
 
+		# Sense from where the player (and the enemies, Map moves them
+		# first) ended up, so get_info() is all from the same moment
+
+		# Update the radar (it writes into the map's detected mask)
+		self.radar(self.radar_radius)
+
+		# Update the feelers
+		self.feelers()
+
 	def go_forward(self):
 		# Save the original position in case we collide and need to revert
 		original_position = (self.x, self.y)
@@ -448,25 +528,73 @@ class Player(GameObject):
 		new_pos = self.rect.copy()
 		new_pos.x = self.x
 		new_pos.y = self.y
-		if new_pos.collidelist(self.parent.walls) != -1:
-			print "Collision!"
+		nearby_walls = list(self.parent.wall_grid.query(new_pos))
+		if new_pos.collidelist(nearby_walls) != -1:
+			self.collisions += 1
+			if self.verbose:
+				print "Collision!"
 			# If there is a collision, move back to the original position (disallow it)
 			self.x, self.y = original_position
 		else:
 			# Apply the position updates to the Player's rect
 			self.rect = new_pos
 
+	def info_layout(self):
+		""" Return [(field, size)] in the order get_info() lays them out """
+		return info_layout(len(self.feeler_offsets), len(self.parent.enemies))
+
+	def info_scale(self):
+		""" Return info_scale() for this player's frames """
+		return info_scale(len(self.info), len(self.feeler_offsets), self.feeler_length, self.parent.rect.size)
+
 	def get_info(self):
-		""" Return information to be sent to the ANN """
-		pass
+		""" 	Return information to be sent to the ANN, as a float32 array that's
+			reused (overwritten) every call:
+
+			pose => x, y of the player's top left
+			heading => cos and sin of theta
+			feelers => the distance each feeler reaches, left to right
+			radar => 1 for each of the map's enemies on the radar, else 0
+			goal => unit vector from the player's center towards the goal's
+		"""
+		info = self.info
+		info[0] = self.x
+		info[1] = self.y
+		info[2] = math.cos(self.theta)
+		info[3] = math.sin(self.theta)
+
+		feelers_end = 4 + len(self.feeler_distances)
+		info[4:feelers_end] = self.feeler_distances
+		radar_end = feelers_end + len(self.parent.detected)
+		info[feelers_end:radar_end] = self.parent.detected
+
+		goal_x, goal_y = self.parent.goal.rect.center
+		x, y = self.rect.center
+		distance = math.hypot(goal_x - x, goal_y - y) or 1.0
+		info[radar_end] = (goal_x - x) / distance
+		info[radar_end + 1] = (goal_y - y) / distance
+		return info
+
+	def publish_frame(self):
+		""" Snapshot the sensors for the connection thread. It only ever reads
+			frame, so it never sees get_info()'s buffer or the pose mid-tick.
+		"""
+		self.frame = (self.ticks, self.get_info().copy())
 
-	# Pseudo code for the cost function
-	# TODO: fill this in with real functions/code
 	def cost_function(self):
-		cost_reducer = 1
-		if self.can_see(self.parent.goal):
-			cost_reducer = 100
-		return distance(self, self.parent.goal) / cost_reducer
+		""" Return how badly the player is doing (lower is better): the distance
+			from its center to the goal's, plus COLLISION_COST per collision
+		"""
+		goal_x, goal_y = self.parent.goal.rect.center
+		x, y = self.rect.center
+		return math.hypot(goal_x - x, goal_y - y) + COLLISION_COST * self.collisions
+
+	def reached_goal(self):
+		return self.rect.colliderect(self.parent.goal.rect)
+
+	def command_mask(self):
+		""" Return the controls being held as a wire.py command mask """
+		return wire.commandMask([self.turn_right, self.turn_left, self.move_forward])
 
 	# Use this for moving the player
 	def notify(self, command, state=True):
@@ -480,30 +608,94 @@ class Player(GameObject):
 			print "Invalid command (this shouldn't happen!)"
 
 
+class Goal(GameObject):
+
+	static = True
+
+	def __init__(self, parent, position, radius=10):
+		super(Goal, self).__init__(parent, position, (2 * radius, 2 * radius))
+		self.radius = radius
+
+	def draw(self, surface):
+		return [pygame.draw.circle(surface, Color.yellow, self.rect.center, self.radius)]
+
 class Wall(GameObject):
 
+	static = True
+
 	def __init__(self, parent, position, dimension):
 		super(Wall, self).__init__(parent, position, dimension)
 
 	def draw(self, surface):
-		wall_surface = surface.subsurface(self.rect)
-		wall_surface.fill(Color.black)
+		return [surface.fill(Color.black, self.rect)]
+
+class SpatialGrid(object):
+	""" 	Buckets objects by the grid cells their rects overlap, so finding what's
+		near a rect only looks at the objects in the cells it covers rather than
+		at every object
+	"""
+
+	def __init__(self, cell_size=GRID_CELL_SIZE):
+		self.cell_size = cell_size
+		# (column, row) => set of objects
+		self.cells = {}
+
+	def span(self, rect):
+		size = self.cell_size
+		return (rect.left // size, rect.top // size,
+			(rect.right - 1) // size, (rect.bottom - 1) // size)
+
+	def cells_in(self, span):
+		left, top, right, bottom = span
+		for column in range(left, right + 1):
+			for row in range(top, bottom + 1):
+				yield (column, row)
+
+	def insert(self, obj):
+		for cell in self.cells_in(self.span(obj.rect)):
+			self.cells.setdefault(cell, set()).add(obj)
+
+	def query(self, rect):
+		""" Return the set of objects in the cells a rect covers (they may not overlap it) """
+		found = set()
+		for cell in self.cells_in(self.span(rect)):
+			bucket = self.cells.get(cell)
+			if bucket:
+				found.update(bucket)
+		return found
 
 class Map(GameObject):
 
 	def __init__(self, parent, position, dimension):
 		super(Map, self).__init__(parent, position, dimension)
 
+		# Walls never move, so they're only bucketed once. Enemies aren't
+		# bucketed, the radar checks them all at once (see radar_hits()).
+		self.wall_grid = SpatialGrid()
+
+		# See draw()
+		self.background = None
+		self.last_drawn = []
+
 		# Create the walls, enemies, and player
 		self.walls = self.create_walls()
+		# The walls' rects as rows of (x, y, width, height) for the feelers
+		self.wall_rects = numpy.array([ tuple(wall.rect) for wall in self.walls ], dtype=float).reshape(-1, 4)
 		self.enemies = self.create_enemies()
+		# The enemies' rects as rows of (x, y, width, height) and which ones
+		# the player's radar picked up, for working on them all at once
+		self.enemy_rects = numpy.array([ tuple(enemy.rect) for enemy in self.enemies ], dtype=float).reshape(-1, 4)
+		self.detected = numpy.zeros(len(self.enemies), dtype=bool)
+		self.goal = Goal(self, GOAL)
 		self.player = Player(self, PLAYER_START)
 
 	def create_walls(self):
 		walls = []
 		for pos, dim in WALLS:
 			new_wall = Wall(self, pos, dim)
+			new_wall.index = len(walls)
 			walls.append(new_wall)
+			self.wall_grid.insert(new_wall)
 
 		return walls
 
@@ -511,13 +703,44 @@ class Map(GameObject):
 		enemies = []
 		for pos in ENEMIES:
 			new_enemy = StaticEnemy(self, pos)
+			new_enemy.index = len(enemies)
 			enemies.append(new_enemy)
 
 		return enemies
 
+	def invalidate(self):
+		""" Redraw the cached background (and the whole map) on the next draw() """
+		self.background = None
+
 	def draw(self, surface):
-		surface.fill(Color.white)
-		super(Map, self).draw(surface)
+		""" 	Draw the map and return the rects that changed since the last draw
+
+			The background and the static objects (walls, the goal) are drawn once
+			into a cached surface. Each frame only the rects drawn on last frame
+			are restored from it before the moving objects are drawn again.
+		"""
+		if self.background is None:
+			self.background = pygame.Surface(surface.get_size())
+			self.background.fill(Color.white)
+			for obj in self.objects:
+				if obj.static:
+					obj.draw(self.background)
+
+			surface.blit(self.background, (0, 0))
+			self.last_drawn = []
+			changed = [surface.get_rect()]
+		else:
+			for rect in self.last_drawn:
+				surface.blit(self.background, rect, rect)
+			changed = self.last_drawn
+
+		drawn = []
+		for obj in self.objects:
+			if not obj.static:
+				drawn.extend(obj.draw(surface))
+
+		self.last_drawn = drawn
+		return changed + drawn
 
 class Button(GameObject):
 
@@ -541,24 +764,40 @@ class InfoBox(GameObject):
 	# Draw information about the 'player' and provide
 	# some buttons to modify the game
 	def draw(self, surface):
-		pass
+		return []
 
 class Simulation(GameObject):
 
-	def __init__(self, resolution=(840, 512)):
+	def __init__(self, resolution=(840, 512), headless=False):
+		""" 	headless => don't connect to the ANN or use the display; drive the
+				simulation with step() instead of mainloop()
+		"""
 		super(Simulation, self).__init__(None, dimension=resolution)
 
 		# Set resolution for top-level objects
 		self.resolution = resolution
 		# Game resolution width and height are multiples of 64 for easy image scaling
-		self.game_resolution = (640, 512)
+		self.game_resolution = GAME_RESOLUTION
 		self.infobox_resolution = (200, 512)
 
 		# Global settings
 		self.running = True
 		self.title = 'Simulation'
-		self.framerate = 60
-		self.clock = pygame.time.Clock()
+		# Ticks per second of wall time (0 runs them as fast as possible)
+		self.tick_rate = TICK_RATE
+		# Draw at most this many frames per second (0 for no limit)...
+		self.render_rate = RENDER_RATE
+		# ...or, if it's set, once every this many ticks
+		self.render_every = RENDER_EVERY
+		# Most ticks to run between checking for input and drawing, so a slow
+		# stretch drops ticks rather than freezing the window while catching up
+		self.max_catch_up = MAX_CATCH_UP
+		self.headless = headless
+		# Game time
+		self.ticks = 0
+		self.time = 0.0
+		# An episodes.Recorder to log every tick to (see record())
+		self.recorder = None
 
 		# Create the game_map and infobox objects
 		game_pos = (0, 0)
@@ -566,13 +805,19 @@ class Simulation(GameObject):
 		self.game_map = Map(self, game_pos, self.game_resolution)
 		self.infobox = InfoBox(self, infobox_pos, self.infobox_resolution, self.game_map)
 
+		self.command_lag = CommandLag()
+		if headless:
+			self.game_map.player.verbose = False
+			return
+
 		# Start sending/receiving with the player (ANN)
-		connection_thread = threading.Thread(target=connection, args=[self.game_map.player])
+		self.game_map.player.publish_frame()
+		connection_thread = threading.Thread(target=connection, args=[self.game_map.player, self.command_lag])
 		connection_thread.daemon = True
 		connection_thread.start()
 
 	def quit(self):
-		self.running = false
+		self.running = False
 
 	def keytoggle(self, key, state):
 		if key == K_ESCAPE:
@@ -601,11 +846,49 @@ class Simulation(GameObject):
 			elif event.type == MOUSEBUTTONUP:
 				self.mouse_up(event.pos, event.button)
 
+	def record(self, path):
+		""" Start logging every tick to an episode log (see episodes.py) """
+		player = self.game_map.player
+		self.recorder = episodes.Recorder(path, len(player.get_info()), len(self.game_map.enemies))
+
+	def stop_recording(self):
+		if self.recorder:
+			self.recorder.close()
+			self.recorder = None
+
 	def update(self):
+		if self.recorder:
+			# The state going into the tick and the commands held during it
+			player = self.game_map.player
+			self.recorder.record(self.ticks, player.command_mask(), (player.x, player.y, player.theta),
+				self.game_map.enemy_rects[:, :2], player.get_info())
+
 		self.game_map.update()
 		self.infobox.update()
+		if not self.headless:
+			self.game_map.player.publish_frame()
+
+		self.ticks += 1
+		self.time = self.ticks * TIMESTEP
+
+	def step(self, commands=None):
+		""" 	Run one tick and return the player's info (what the ANN would get)
+
+			commands => the controls to hold during the tick, as a command mask or
+				a list in wire.COMMANDS order (None keeps the current ones)
+		"""
+		if commands is not None:
+			if isinstance(commands, (int, long)):
+				commands = wire.commandStates(commands)
+			player = self.game_map.player
+			for command, state in zip(wire.COMMANDS, commands):
+				player.notify(command, bool(state))
+
+		self.update()
+		return self.game_map.player.get_info()
 
 	def draw(self, window):
+		""" Draw the frame and return the rects of the window that changed """
 		# Get the surface representing the game's drawing area
 		game_surface_rect = Rect((0, 0), self.game_resolution)
 		game_surface = window.subsurface(game_surface_rect)
@@ -615,22 +898,60 @@ class Simulation(GameObject):
 		infobox_surface = window.subsurface(infobox_surface_rect)
 
 		# Draw the game
-		self.game_map.draw(game_surface)
+		dirty = [ rect.move(game_surface_rect.topleft) for rect in self.game_map.draw(game_surface) ]
 
 		# Draw the infobox
-		self.infobox.draw(infobox_surface)
+		dirty.extend(rect.move(infobox_surface_rect.topleft) for rect in self.infobox.draw(infobox_surface))
+		return dirty
 
 	def mainloop(self, window):
-		while self.running:
-			time = self.clock.tick(self.framerate)
+		""" 	Run the simulation on a fixed timestep, drawing separately
 
+			Game time only moves in whole ticks (speeds are per tick), tick_rate of
+			them per second, however often frames are drawn. With a tick_rate of 0
+			ticks run back to back between frames.
+		"""
+		tick_seconds = 1.0 / self.tick_rate if self.tick_rate else 0.0
+		frame_seconds = 1.0 / self.render_rate if self.render_rate else 0.0
+		next_tick = next_frame = time.time()
+		ticks_since_frame = 0
+
+		while self.running:
 			self.check_input(pygame.event.get())
-			self.update()
-			self.draw(window)
 
-			pygame.display.flip()
+			# Run the ticks that are due, up to the catch up budget
+			now = time.time()
+			ticks = 0
+			while ticks < self.max_catch_up and (not tick_seconds or next_tick <= now):
+				self.update()
+				ticks += 1
+				next_tick += tick_seconds
+				if not tick_seconds and not self.render_every and time.time() >= next_frame:
+					break
+			if tick_seconds and next_tick <= now:
+				# Too far behind, let the missed ticks go
+				next_tick = now
+			ticks_since_frame += ticks
+
+			now = time.time()
+			if self.render_every:
+				render = ticks_since_frame >= self.render_every
+			else:
+				render = ticks_since_frame and now >= next_frame
+			if render:
+				# Only push the parts of the window that changed
+				pygame.display.update(self.draw(window))
+				ticks_since_frame = 0
+				next_frame = max(next_frame + frame_seconds, now)
 			pygame.event.pump()
 
+			# Sleep until there's something to do
+			if tick_seconds:
+				wake = next_tick if self.render_every else min(next_tick, next_frame)
+				delay = wake - time.time()
+				if delay > 0:
+					time.sleep(delay)
+
 def drawText(surface, msg, location = (0,0), size = 20, color = Color.white):
 	font = pygame.font.Font(None, size)
 	msgsurface = font.render(msg, False, color)
@@ -639,51 +960,184 @@ def drawText(surface, msg, location = (0,0), size = 20, color = Color.white):
 	surface.blit(msgsurface, rect)
 	return rect
 
-def connection(player):
+class CommandLag(object):
+	""" How many ticks old the ANN's commands are when they're applied """
+
+	def __init__(self):
+		self.last = 0
+		self.maximum = 0
+		self.total = 0
+		self.count = 0
+		# Replies thrown away because a newer one had already arrived, and
+		# frames given up on after IN_FLIGHT_EXPIRY ticks without one
+		self.dropped = 0
+
+	def record(self, lag):
+		self.last = lag
+		self.maximum = max(self.maximum, lag)
+		self.total += lag
+		self.count += 1
+
+		if LAG_REPORT_INTERVAL and self.count % LAG_REPORT_INTERVAL == 0:
+			print self
+
+	@property
+	def mean(self):
+		return float(self.total) / self.count if self.count else 0.0
+
+	def __str__(self):
+		return "Command lag: {} frames (mean {:.2f}, max {}, {} stale replies or lost frames dropped)".format(
+			self.last, self.mean, self.maximum, self.dropped)
+
+def apply_commands(player, msg_type, payload):
+	""" Set the player's controls from a command message """
+	if msg_type != wire.MSG_COMMANDS:
+		print "Invalid commands"
+		return
+
+	# Commands are states rather than presses, so a 0 lets go of the control
+	for command, state in zip(wire.COMMANDS, wire.commands(payload)):
+		player.notify(command, state)
+
+def send_info(socket, player, envelope=()):
+	""" Send the player's latest frame (see Simulation.update) and return its tick """
+	tick, info = player.frame
+	wire.sendSensors(socket, tick, info, envelope)
+	return tick
+
+def connection(player, lag=None):
+	if lag is None:
+		lag = CommandLag()
+
+	if USE_ASYNC:
+		async_connection(player, lag)
+	else:
+		lockstep_connection(player, lag)
+
+def lockstep_connection(player, lag):
 	# create the server and the client for communication with ANN.
 	# server for receiving commands from the ANN
 	context = zmq.Context()
 	socket = context.socket(zmq.REQ)
-	socket.bind('tcp://127.0.0.1:1234')
-	socket.connect('tcp://127.0.0.1:1235')
+	socket.bind(SIM_ADDRESS)
+	socket.connect(ANN_ADDRESS)
 
 	while True:
 		# send output to ANN.
-		output_list = player.get_info()
-		output_string = pickle.dumps(output_list)
-		socket.send(output_string)
+		send_info(socket, player)
 
 		# receive reply from ANN
-		msg = socket.recv()
-		list_message = pickle.loads(msg)
-		if list_message:
-
-			# position 1 will be turn right
-			turn_right = list_message[0]
-			if turn_right:
-				player.notify('turn_right')
-
-			# position 2 will be turn left
-			turn_left = list_message[1]
-			if turn_left:
-				player.notify('turn_left')
-
-			# position 3 will be move forward
-			move_forward = list_message[2]
-			if move_forward:
-				player.notify('move_forward')
-		else:
-			print "Invalid commands"
+		_, msg_type, seq, payload = wire.parse(socket.recv_multipart())
+		apply_commands(player, msg_type, payload)
+		lag.record(player.ticks - seq)
+
+def async_connection(player, lag):
+	context = zmq.Context()
+	socket = context.socket(zmq.DEALER)
+	socket.bind(SIM_ADDRESS)
+	socket.connect(ANN_ADDRESS)
+
+	# The ticks of the frames still waiting on a reply
+	in_flight = []
+	last_sent = None
+	newest_applied = -1
+
+	while True:
+		# Forget frames whose replies aren't coming
+		oldest = player.ticks - IN_FLIGHT_EXPIRY
+		if in_flight and in_flight[0] < oldest:
+			expired = len(in_flight)
+			in_flight = [ seq for seq in in_flight if seq >= oldest ]
+			lag.dropped += expired - len(in_flight)
+
+		# Send at most one frame per tick
+		if player.frame[0] != last_sent and len(in_flight) < MAX_IN_FLIGHT:
+			# The empty frame is the delimiter ROUTER/REP sockets expect
+			tick = send_info(socket, player, [''])
+			in_flight.append(tick)
+			last_sent = tick
+
+		if not socket.poll(POLL_TIMEOUT):
+			continue
+
+		replies = []
+		while socket.poll(0):
+			try:
+				_, msg_type, seq, payload = wire.parse(socket.recv_multipart())
+			except wire.ProtocolError as e:
+				print "Bad reply: {}".format(e)
+				continue
+			replies.append((seq, msg_type, payload))
+		if not replies:
+			continue
+		replies.sort()
+
+		# The ANN answers frames in order (and may skip stale ones), so
+		# everything up to the newest reply is done with
+		in_flight = [ seq for seq in in_flight if seq > replies[-1][0] ]
+
+		if CONFLATE:
+			lag.dropped += len(replies) - 1
+			if replies[-1][0] <= newest_applied:
+				lag.dropped += 1
+				continue
+			replies = replies[-1:]
+
+		for seq, msg_type, payload in replies:
+			apply_commands(player, msg_type, payload)
+			newest_applied = max(newest_applied, seq)
+			lag.record(player.ticks - seq)
+
+def headless_main(ticks, record=None):
+	""" Run the simulation without a display, holding random controls, and
+		print how fast it goes
+	"""
+	sim = Simulation(headless=True)
+	if record:
+		sim.record(record)
+	rand = random.Random(0)
+
+	start = time.time()
+	for tick in xrange(ticks):
+		if tick % 30 == 0:
+			commands = rand.randint(0, 7)
+		sim.step(commands)
+	seconds = time.time() - start
+	sim.stop_recording()
+
+	print "{} ticks ({:.0f} s of game time) in {:.2f} s: {:.0f} ticks/s, {:.0f}x real time".format(
+		ticks, sim.time, seconds, ticks / seconds, sim.time / seconds)
 
 def main():
+	parser = argparse.ArgumentParser(description='Simulation for the neural network')
+	parser.add_argument('--headless', action='store_true', help="don't open a window, just time the simulation")
+	parser.add_argument('--ticks', type=int, default=100000, help='ticks to run headless')
+	parser.add_argument('--tick-rate', type=int, default=TICK_RATE, help='ticks per second (0 for as fast as possible)')
+	parser.add_argument('--render-rate', type=int, default=RENDER_RATE, help='most frames per second to draw (0 for no limit)')
+	parser.add_argument('--render-every', type=int, default=RENDER_EVERY, help='draw once every this many ticks instead')
+	parser.add_argument('--record', metavar='PATH', help='log every tick to an episode log')
+	args = parser.parse_args()
+
+	if args.headless:
+		headless_main(args.ticks, args.record)
+		return
+
 	sim = Simulation()
+	sim.tick_rate = args.tick_rate
+	sim.render_rate = args.render_rate
+	sim.render_every = args.render_every
 
 	pygame.init()
 	pygame.display.set_mode(sim.resolution)
 	pygame.display.set_caption(sim.title)
 
 	window = pygame.display.get_surface()
-	sim.mainloop(window)
+	if args.record:
+		sim.record(args.record)
+	try:
+		sim.mainloop(window)
+	finally:
+		sim.stop_recording()
 
 if __name__ == "__main__":
 	main()
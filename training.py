@@ -0,0 +1,214 @@
+# Neural Network
+# -- training.py
+#
+# @package NeuralNetwork
+
+# Offline training on recorded episodes (see episodes.py).
+#
+# The network learns to pick the commands held in the recordings from the
+# sensor frames that went with them. Nothing is loaded up front: the logs
+# are streamed a chunk at a time, the (observation, target) pairs go through
+# a bounded shuffle window, and mini-batches are built ahead of time on a
+# background thread while the network trains on the previous ones. Memory
+# use depends on the window and the batch size, not on how much is recorded.
+#
+#   $ python training.py run1.log run2.log --epochs 5 --save trained.wgnn
+
+import Queue
+import contextlib
+import random
+import threading
+import time
+
+import numpy
+
+import episodes
+import sequential_nn
+import sim
+import wire
+
+BATCH_SIZE = 64
+# Pairs held for shuffling. Bigger mixes better (across chunks and logs).
+SHUFFLE_WINDOW = 10000
+# Batches built ahead of the one being trained on
+PREFETCH_DEPTH = 4
+# How often (in seconds) the prefetch thread checks whether it's been stopped
+# while waiting for room
+PUT_TIMEOUT = .1
+NUM_HIDDEN = 32
+
+def commandTargets(masks):
+    """ Return command masks as rows of 0/1 targets in wire.COMMANDS order """
+    bits = 1 << numpy.arange(len(wire.COMMANDS))
+    return ((masks[:, None] & bits) != 0).astype(numpy.float64)
+
+def episodePairs(paths, rand=None):
+    """ Yield (scaled observations, targets) a chunk at a time from episode
+        logs, in a random order of logs if rand is given
+    """
+    paths = list(paths)
+    if rand is not None:
+        rand.shuffle(paths)
+
+    for path in paths:
+        episode = episodes.Episode(path)
+        # Scaled like every network's inputs (see sim.info_scale)
+        scale = sim.info_scale(episode.observation_size).astype(numpy.float64)
+        try:
+            for records in episode.chunksFrom(0):
+                yield records['observation'] * scale, commandTargets(records['commands'])
+        finally:
+            episode.close()
+
+def shuffledBatches(pairs, batch_size=BATCH_SIZE, window=SHUFFLE_WINDOW, rand=None):
+    """ Yield (inputs, targets) mini-batches drawn at random from a window of
+        the pairs coming from 'pairs' (an iterable of (inputs, targets) arrays)
+    """
+    rand = rand or numpy.random.RandomState()
+    window = max(window, batch_size)
+    inputs_window = targets_window = None
+    count = 0
+
+    for inputs, targets in pairs:
+        if inputs_window is None:
+            inputs_window = numpy.empty((window, inputs.shape[1]))
+            targets_window = numpy.empty((window, targets.shape[1]))
+
+        position = 0
+        while position < len(inputs):
+            take = min(window - count, len(inputs) - position)
+            inputs_window[count:count + take] = inputs[position:position + take]
+            targets_window[count:count + take] = targets[position:position + take]
+            count += take
+            position += take
+
+            if count < window:
+                continue
+
+            # Full: hand out a random batch and fill its slots with the rows
+            # at the end of the window, so the window stays packed
+            slots = rand.choice(count, batch_size, replace=False)
+            yield inputs_window[slots], targets_window[slots]
+
+            tail = numpy.arange(count - batch_size, count)
+            holes = slots[slots < count - batch_size]
+            movers = tail[~numpy.in1d(tail, slots)]
+            inputs_window[holes] = inputs_window[movers]
+            targets_window[holes] = targets_window[movers]
+            count -= batch_size
+
+    # Out of pairs, shuffle what's left
+    order = rand.permutation(count)
+    for start in range(0, count, batch_size):
+        slots = order[start:start + batch_size]
+        yield inputs_window[slots], targets_window[slots]
+
+def prefetch(iterable, depth=PREFETCH_DEPTH):
+    """ Run through an iterable on a background thread, staying up to depth
+        items ahead of the caller, and yield its items in order
+    """
+    done = object()
+    queue = Queue.Queue(depth)
+    # Set when the caller stops early, so the worker doesn't wait forever
+    # for room in the queue
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=PUT_TIMEOUT)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def run():
+        try:
+            for item in iterable:
+                if not put(item):
+                    break
+            else:
+                put(done)
+        except Exception as error:
+            # Hand it to the caller
+            put(error)
+        finally:
+            # Lets go of whatever the iterable holds (e.g. an open episode)
+            close = getattr(iterable, 'close', None)
+            if close:
+                close()
+
+    worker = threading.Thread(target=run)
+    worker.daemon = True
+    worker.start()
+
+    try:
+        while True:
+            item = queue.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+def train(nn, paths, epochs=1, batch_size=BATCH_SIZE, window=SHUFFLE_WINDOW,
+          depth=PREFETCH_DEPTH, seed=None, learning_rate=None):
+    """ Train a network on episode logs, returning the mean loss of each epoch """
+    rand = random.Random(seed)
+    shuffle_rand = numpy.random.RandomState(seed)
+
+    losses = []
+    for epoch in range(epochs):
+        pairs = episodePairs(paths, rand)
+        total = 0.0
+        batches = 0
+        for inputs, targets in prefetch(shuffledBatches(pairs, batch_size, window, shuffle_rand), depth):
+            total += nn.trainBatch(inputs, targets, learning_rate)
+            batches += 1
+        losses.append(total / batches if batches else 0.0)
+
+    return losses
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Train a network on recorded episodes')
+    parser.add_argument('paths', nargs='+', help='episode logs')
+    parser.add_argument('--epochs', type=int, default=1)
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--window', type=int, default=SHUFFLE_WINDOW, help='pairs to shuffle across')
+    parser.add_argument('--hidden', type=int, default=NUM_HIDDEN, help='hidden layer size')
+    parser.add_argument('--learning-rate', type=float, default=.05)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--load', help='checkpoint to keep training from')
+    parser.add_argument('--save', help='checkpoint to write when done')
+    args = parser.parse_args()
+
+    if args.load:
+        nn = sequential_nn.NeuralNetwork.load(args.load, learning_rate=args.learning_rate)
+    else:
+        first = episodes.Episode(args.paths[0])
+        nn = sequential_nn.NeuralNetwork([ first.observation_size, args.hidden, len(wire.COMMANDS) ],
+                                         use_numpy=True, learning_rate=args.learning_rate, seed=args.seed)
+        first.close()
+
+    samples = 0
+    for path in args.paths:
+        with contextlib.closing(episodes.Episode(path)) as episode:
+            samples += len(episode)
+    for epoch in range(args.epochs):
+        start = time.time()
+        loss, = train(nn, args.paths, 1, args.batch_size, args.window,
+                      seed=None if args.seed is None else args.seed + epoch)
+        seconds = time.time() - start
+        print "Epoch {}: loss {:.4f}, {:.0f} samples/s".format(epoch + 1, loss, samples / seconds)
+
+    if args.save:
+        nn.save(args.save)
+
+if __name__ == "__main__":
+    main()
+
+# vim:ts=4:sw=4:sta:et:
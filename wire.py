@@ -0,0 +1,189 @@
+# Neural Network
+# -- wire.py
+#
+# @package NeuralNetwork
+
+# The messages between the simulation (sim.py) and the ANN (nn.py). Both ends
+# import this file, so they always agree on the layout, and the version in
+# every header catches one end running an older copy.
+#
+# A message is two zmq frames (after whatever routing envelope the socket
+# adds):
+#
+#   header  - HEADER: version (uint8), type (uint8), reserved (uint16),
+#             sequence (uint64), payload length in bytes (uint32)
+#   payload - MSG_SENSORS: the sensor vector as little endian float32s
+#             MSG_COMMANDS: COMMAND_MASK, bit i set if COMMANDS[i] is on
+#             MSG_ERROR: empty, the frame with that sequence was bad
+#
+# The payload frame is sent straight from the vector's buffer (copy=False)
+# and read back with frombuffer, so neither end builds Python objects per
+# value the way pickle does, and nothing received can run code.
+#
+# Running this file compares it against pickle:
+#
+#   $ python wire.py --sensors 64 --frames 100000
+
+import array
+import pickle
+import struct
+import sys
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+VERSION = 1
+HEADER = struct.Struct('<BBHQI')
+COMMAND_MASK = struct.Struct('<I')
+
+MSG_SENSORS = 1
+MSG_COMMANDS = 2
+MSG_ERROR = 3
+
+# Bit i of a command mask is COMMANDS[i]. Same order as the ANN's outputs.
+COMMANDS = [ 'turn_right', 'turn_left', 'move_forward' ]
+
+SENSOR_DTYPE = '<f4'
+# array's 'f' is native endian, which is only the wire's on little endian hosts
+USE_ARRAY = sys.byteorder == 'little'
+
+class ProtocolError(ValueError):
+    pass
+
+def header(msg_type, seq, length):
+    return HEADER.pack(VERSION, msg_type, 0, seq, length)
+
+def sensorBuffer(values):
+    """ Return values as a float32 buffer, without copying if they already are one """
+    if numpy is not None:
+        return numpy.ascontiguousarray(values, dtype=SENSOR_DTYPE)
+    if not USE_ARRAY:
+        return struct.pack('<{}f'.format(len(values)), *values)
+    if isinstance(values, array.array) and values.typecode == 'f':
+        return values
+    return array.array('f', values)
+
+def bufferSize(buf):
+    if isinstance(buf, str):
+        return len(buf)
+    if isinstance(buf, array.array):
+        return len(buf) * buf.itemsize
+    return buf.nbytes
+
+def sendSensors(socket, seq, values, envelope=()):
+    """ Send a sensor vector. zmq still copies frames under its copy
+        threshold, but bigger ones go out from the vector's own buffer, so
+        don't change it until the message has been sent.
+    """
+    buf = sensorBuffer(values)
+    socket.send_multipart(list(envelope) + [ header(MSG_SENSORS, seq, bufferSize(buf)), buf ], copy=False)
+
+def sendCommands(socket, seq, outputs, envelope=()):
+    """ Send the commands for a list of outputs (truthy means on) """
+    payload = COMMAND_MASK.pack(commandMask(outputs))
+    socket.send_multipart(list(envelope) + [ header(MSG_COMMANDS, seq, len(payload)), payload ])
+
+def sendError(socket, seq, envelope=()):
+    socket.send_multipart(list(envelope) + [ header(MSG_ERROR, seq, 0), '' ])
+
+def parse(frames):
+    """ Split a received multipart message into (envelope, type, seq, payload),
+        raising ProtocolError if it isn't one of ours
+    """
+    if len(frames) < 2:
+        raise ProtocolError("Expected a header and a payload, got {} frames".format(len(frames)))
+
+    envelope, head, payload = frames[:-2], frames[-2], frames[-1]
+    # zmq.Frame (from copy=False receives) or plain strings
+    head = getattr(head, 'bytes', head)
+    payload = getattr(payload, 'buffer', payload)
+
+    if len(head) != HEADER.size:
+        raise ProtocolError("Bad header size {}".format(len(head)))
+    version, msg_type, _, seq, length = HEADER.unpack(head)
+    if version != VERSION:
+        raise ProtocolError("Version {} message, expected {}".format(version, VERSION))
+    if len(payload) != length:
+        raise ProtocolError("Payload is {} bytes, header says {}".format(len(payload), length))
+
+    return envelope, msg_type, seq, payload
+
+def sensors(payload):
+    """ Return a sensor payload as a float32 vector (a view when possible) """
+    if len(payload) % 4:
+        raise ProtocolError("Sensor payload of {} bytes".format(len(payload)))
+    if numpy is not None:
+        return numpy.frombuffer(payload, dtype=SENSOR_DTYPE)
+    return array.array('f', struct.unpack_from('<{}f'.format(len(payload) // 4), payload))
+
+def commandMask(outputs):
+    mask = 0
+    for bit, output in enumerate(outputs[:len(COMMANDS)]):
+        if output:
+            mask |= 1 << bit
+    return mask
+
+def commands(payload):
+    """ Return a command payload as a list of bools in COMMANDS order """
+    if len(payload) != COMMAND_MASK.size:
+        raise ProtocolError("Command payload of {} bytes".format(len(payload)))
+    mask, = COMMAND_MASK.unpack_from(payload)
+    return commandStates(mask)
+
+def commandStates(mask):
+    """ Return a command mask as a list of bools in COMMANDS order """
+    return [ bool(mask & (1 << bit)) for bit in range(len(COMMANDS)) ]
+
+def timePerFrame(function, frames):
+    start = time.time()
+    for i in xrange(frames):
+        function(i)
+    return (time.time() - start) / frames
+
+def benchmark(num_sensors, frames):
+    """ Return [(name, bytes per frame, seconds per frame)] for encoding and
+        decoding a sensor frame and a command reply both ways
+    """
+    values = [ i / float(num_sensors) for i in range(num_sensors) ]
+    vector = sensorBuffer(values)
+    outputs = [ 1, 0, 1 ]
+
+    def picklePair(i):
+        pickle.loads(pickle.dumps(values, pickle.HIGHEST_PROTOCOL))
+        pickle.loads(pickle.dumps(outputs, pickle.HIGHEST_PROTOCOL))
+
+    def wirePair(i):
+        buf = sensorBuffer(vector)
+        head = header(MSG_SENSORS, i, bufferSize(buf))
+        # What a (copying) recv_multipart would hand the other end
+        sensors(parse([ head, bytes(buffer(buf)) ])[3])
+        payload = COMMAND_MASK.pack(commandMask(outputs))
+        commands(parse([ header(MSG_COMMANDS, i, len(payload)), payload ])[3])
+
+    pickle_bytes = len(pickle.dumps(values, pickle.HIGHEST_PROTOCOL)) + \
+                   len(pickle.dumps(outputs, pickle.HIGHEST_PROTOCOL))
+    wire_bytes = 2 * HEADER.size + num_sensors * 4 + COMMAND_MASK.size
+    return [
+        ('pickle', pickle_bytes, timePerFrame(picklePair, frames)),
+        ('wire', wire_bytes, timePerFrame(wirePair, frames)),
+    ]
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compare the wire format with pickle')
+    parser.add_argument('--sensors', type=int, default=64, help='floats per sensor frame')
+    parser.add_argument('--frames', type=int, default=100000, help='frames to time')
+    args = parser.parse_args()
+
+    for name, size, seconds in benchmark(args.sensors, args.frames):
+        print "{:>6}: {:>5} bytes/frame, {:.2f} us/frame ({:.0f} frames/s on one core)".format(
+            name, size, seconds * 1e6, 1 / seconds)
+
+if __name__ == "__main__":
+    main()
+
+# vim:ts=4:sw=4:sta:et: